@@ -0,0 +1,139 @@
+import os
+import hashlib
+import inspect
+import pickle
+from functools import wraps
+
+import numpy as np
+
+# Cache settings, changed with configure()
+cache_dir = os.path.join('out', 'cache')
+max_size = 10 * 2**30 # bytes
+enabled = True
+refresh = False
+# Running estimate of the cache size in this process
+cache_size = None
+
+def configure(directory=None, size=None, use_cache=None, recompute=None):
+    '''
+    Changes the cache settings. Call before starting worker processes so
+    that they inherit the settings.
+
+    Input
+    -----
+      directory : string, cache directory
+      size : int, maximum cache size in bytes; least recently used results
+             are deleted beyond it
+      use_cache : bool, whether to read and write cached results at all
+      recompute : bool, ignore cached results but still save new ones
+    '''
+    global cache_dir, max_size, enabled, refresh, cache_size
+    if directory is not None: cache_dir, cache_size = directory, None
+    if size is not None: max_size = size
+    if use_cache is not None: enabled = use_cache
+    if recompute is not None: refresh = recompute
+
+def file_key(*files):
+    '''
+    Returns a key for input files made of their paths, sizes and
+    modification times. Files which don't exist are skipped.
+    '''
+    key = []
+    for file in files:
+        if os.path.exists(file):
+            stat = os.stat(file)
+            key.append((file, stat.st_size, stat.st_mtime_ns))
+    return key
+
+def array_key(*arrays):
+    ''' Returns a hex digest of the shapes, data types and values of arrays '''
+    h = hashlib.sha1()
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        h.update(repr((arr.shape, arr.dtype.str)).encode())
+        h.update(arr)
+    return h.hexdigest()
+
+def run_key(run):
+    ''' Returns a key identifying a run '''
+    return (run.mode, run.name, tuple(run.channels))
+
+def cached(key_func):
+    '''
+    Decorator which saves a function's return values to the disk cache.
+    key_func takes the same arguments as the function and returns a
+    description of everything the result depends on, such as file_key() of
+    the input files and the function parameters. The key also includes the
+    source code of the function's module, so editing the module invalidates
+    its cached results.
+    '''
+    def decorator(func):
+        module = inspect.getmodule(func)
+        version = hashlib.sha1(inspect.getsource(module).encode()).hexdigest()
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled: return func(*args, **kwargs)
+            key = hashlib.sha1(repr((func.__module__, func.__qualname__,
+                    version, key_func(*args, **kwargs))).encode()).hexdigest()
+            cache_file = os.path.join(cache_dir, f'{key}.pkl')
+            if not refresh:
+                try:
+                    with open(cache_file, 'rb') as f:
+                        result = pickle.load(f)
+                except (OSError, EOFError, pickle.UnpicklingError):
+                    pass
+                else:
+                    # Mark as recently used
+                    os.utime(cache_file)
+                    return result
+            result = func(*args, **kwargs)
+            save(cache_file, result)
+            return result
+        return wrapper
+    return decorator
+
+def save(cache_file, result):
+    ''' Pickles a result to the cache, then evicts old results if needed '''
+    global cache_size
+    if not os.path.exists(cache_dir): os.makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary file first; several processes may share the cache
+    tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    size = os.path.getsize(tmp_file)
+    os.replace(tmp_file, cache_file)
+    if cache_size is None: cache_size = sum(s for s, m, f in entries())
+    else: cache_size += size
+    if cache_size > max_size: evict()
+
+def entries():
+    ''' Returns a list of (size, last used time, path) of cached results '''
+    cached_entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.pkl'):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            cached_entries.append((stat.st_size, stat.st_mtime, entry.path))
+    return cached_entries
+
+def evict():
+    ''' Deletes least recently used results until the cache fits max_size '''
+    global cache_size
+    cached_entries = entries()
+    cache_size = sum(s for s, m, f in cached_entries)
+    for size, mtime, path in sorted(cached_entries, key=lambda e: e[1]):
+        if cache_size <= max_size: break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        cache_size -= size
+
+def clear():
+    ''' Deletes all cached results '''
+    global cache_size
+    if os.path.exists(cache_dir):
+        for size, mtime, path in entries(): os.remove(path)
+    cache_size = 0
@@ -0,0 +1,109 @@
+import os
+import shutil
+import pickle
+import hashlib
+import traceback
+
+import cache
+
+class Checkpoint:
+    '''
+    Saves the result of each job of a summary as soon as it finishes, so that
+    a summary which is interrupted can be resumed without repeating finished
+    jobs. Each result is pickled to its own file, named after a key which
+    should describe the job and its input files (see cache.file_key()), so
+    results for modified inputs are never reused.
+
+    Jobs whose function is cached with cache.cached() under the same key are
+    already saved by the disk cache, so results are only written here when
+    the cache is disabled or being recomputed and so wouldn't be reused.
+    '''
+    def __init__(self, directory, resume=False):
+        '''
+        Input
+        -----
+          directory : string, checkpoint directory
+          resume : bool, keep the results of a previous attempt; otherwise
+                   they are deleted
+        '''
+        self.directory = directory
+        self.enabled = not cache.enabled or cache.refresh
+        if not resume: self.clear()
+
+    def checkpoint_file(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.directory, f'{digest}.pkl')
+
+    def __contains__(self, key):
+        return os.path.exists(self.checkpoint_file(key))
+
+    def load(self, key):
+        ''' Returns the saved result of a job '''
+        with open(self.checkpoint_file(key), 'rb') as f:
+            return pickle.load(f)
+
+    def save(self, key, result):
+        ''' Saves the result of a job, unless the disk cache already has it '''
+        if not self.enabled: return
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        checkpoint_file = self.checkpoint_file(key)
+        # Write to a temporary file first so an interruption never leaves a
+        # partial result behind
+        with open(checkpoint_file + '.tmp', 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+    def clear(self):
+        '''
+        Deletes all saved results, and the parent checkpoint directory if no
+        other summary has results in it
+        '''
+        if os.path.exists(self.directory): shutil.rmtree(self.directory)
+        parent = os.path.dirname(self.directory)
+        try:
+            if parent and len(os.listdir(parent)) == 0: os.rmdir(parent)
+        except OSError:
+            # Missing, or another summary started checkpointing meanwhile
+            pass
+
+class Guard:
+    '''
+    Wraps a job function for utils.imap so that a job which fails, such as
+    on a corrupt or unreadable input file, doesn't stop the others. Calls
+    return a tuple of the result and None, or of None and the traceback if
+    the job failed.
+    '''
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, item):
+        try:
+            return self.func(item), None
+        except Exception:
+            return None, traceback.format_exc()
+
+def save_quarantine(report_file, failures):
+    '''
+    Writes a report of the inputs which failed and were left out of a
+    summary, with the error of each, or deletes the old report if there
+    were no failures.
+
+    Input
+    -----
+      report_file : string, path to the report
+      failures : dict of input descriptions and tracebacks
+    '''
+    if len(failures) == 0:
+        if os.path.exists(report_file): os.remove(report_file)
+        return
+    with open(report_file, 'w') as f:
+        f.write(f'{len(failures)} inputs failed and were left out of the '
+                'summary:\n')
+        for name, error in failures.items():
+            f.write(f'  {name}: {error.strip().splitlines()[-1]}\n')
+        f.write('\nTracebacks:\n')
+        for name, error in failures.items():
+            f.write(f'\n{name}\n{error}')
+    print(f'{len(failures)} inputs failed and were quarantined; see '
+            f'{report_file}')
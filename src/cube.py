@@ -0,0 +1,193 @@
+import hashlib
+import warnings
+
+import numpy as np
+import pandas as pd
+
+# Summary statistics, in column order
+stats = np.array(['MEDIAN', 'CI_50_LO', 'CI_50_HI', 'CI_90_LO', 'CI_90_HI'])
+# Deviations of the median PSD from its baseline, in array order
+deviations = np.array(['ABS', 'FRAC'])
+
+def get_baseline(median):
+    '''
+    Returns the baseline PSD, the median over time of the median PSD.
+    Frequencies with no data are NaN.
+
+    Input
+    -----
+      median : array of median PSDs with the time axis second to last
+    '''
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return np.nanmedian(median, axis=-2)
+
+def get_deviations(median, baseline):
+    '''
+    Returns the absolute and fractional deviations of the median PSD from
+    the baseline, stacked along a new first axis.
+
+    Input
+    -----
+      median : array of median PSDs with the time axis second to last
+      baseline : array of baseline PSDs, as returned by get_baseline()
+    '''
+    diff = median - baseline[...,np.newaxis,:]
+    return np.stack([diff, diff / baseline[...,np.newaxis,:]])
+
+def content_hash(times, freqs, median, chunk_size=256):
+    '''
+    Returns a hex digest of the times, frequencies and median PSD of one
+    channel, which together determine its FFT. The median PSD, index order
+    [time, frequency], may be memory-mapped; it is hashed a chunk of times
+    at a time.
+    '''
+    h = hashlib.sha1()
+    for arr in [times, freqs]:
+        h.update(np.ascontiguousarray(arr, dtype='float64'))
+    for i in range(0, len(median), chunk_size):
+        h.update(np.ascontiguousarray(median[i:i+chunk_size], dtype='float64'))
+    return h.hexdigest()
+
+class PsdCube:
+    '''
+    A class to store PSD summaries as one dense array with index order
+    [statistic, channel, time, frequency]. Times and frequencies are sorted,
+    and missing values are NaN. Selections return views of the array rather
+    than copies.
+    '''
+    def __init__(self, data, channels, times, freqs, missing=None,
+            baseline=None, deviation=None):
+        '''
+        Input
+        -----
+          data : 4D numpy array, index order [statistic, channel, time, freq]
+          channels : array of channel names
+          times : sorted array of GPS times
+          freqs : sorted array of frequencies
+          missing : boolean array, True for times filled in for time gaps
+          baseline : 2D array of baseline PSDs, index order [channel, freq];
+                     calculated when first needed if not given
+          deviation : 4D array of deviations from the baseline, index order
+                      [deviation, channel, time, freq]; calculated when 
+                      first needed if not given
+        '''
+        self.baseline = baseline
+        self.deviation = deviation
+        self.data = data
+        self.channels = np.asarray(channels)
+        self.times = np.asarray(times)
+        self.freqs = np.asarray(freqs)
+        if missing is None: missing = np.zeros(len(times), dtype=bool)
+        self.missing = np.asarray(missing)
+        # Lookup tables from labels to array indices
+        self.stat_idx = {s: i for i, s in enumerate(stats)}
+        self.channel_idx = {c: i for i, c in enumerate(self.channels)}
+        self.time_idx = {t: i for i, t in enumerate(self.times)}
+        self.freq_idx = {f: i for i, f in enumerate(self.freqs)}
+
+    @classmethod
+    def from_frame(cls, summary):
+        '''
+        Returns a PsdCube from a summary DataFrame MultiIndexed by channel,
+        time and frequency, as output by psd.save_summary(). Times where all
+        values are NaN are marked as missing.
+        '''
+        channels = np.array(summary.index.unique(level='CHANNEL'))
+        times = np.array(sorted(summary.index.unique(level='TIME')))
+        freqs = np.array(sorted(summary.index.unique(level='FREQ')))
+        # Array indices of each row
+        c = pd.Index(channels).get_indexer(
+                summary.index.get_level_values('CHANNEL'))
+        t = np.searchsorted(times, summary.index.get_level_values('TIME'))
+        f = np.searchsorted(freqs, summary.index.get_level_values('FREQ'))
+        data = np.full((len(stats), len(channels), len(times), len(freqs)),
+                np.nan)
+        data[:,c,t,f] = summary[stats].to_numpy(dtype='float64').T
+        missing = np.isnan(data).all(axis=(0, 1, 3))
+        return cls(data, channels, times, freqs, missing)
+
+    def to_frame(self):
+        '''
+        Returns the summary DataFrame MultiIndexed by channel, time and
+        frequency. Frequencies which weren't summarized at a given time are
+        dropped, except in time gaps, where frequencies summarized at any
+        other time are kept.
+        '''
+        # Frequencies summarized at any time in any channel
+        valid_freqs = ~np.isnan(self.data).all(axis=(0, 1, 2))
+        summaries = []
+        for channel in sorted(self.channels):
+            # Reshape to [time, frequency, statistic] and flatten first two axes
+            arr = self.data[:,self.channel_idx[channel]].transpose(1, 2, 0)
+            arr = arr.reshape(-1, len(stats))
+            midx = pd.MultiIndex.from_product(
+                    [[channel], self.times, self.freqs],
+                    names=['CHANNEL', 'TIME', 'FREQ'])
+            keep = ~np.isnan(arr).all(axis=1) \
+                | np.outer(self.missing, valid_freqs).ravel()
+            summaries.append(pd.DataFrame(arr[keep], index=midx[keep],
+                    columns=stats))
+        return pd.concat(summaries)
+
+    def select(self, channel):
+        ''' Returns a PsdCube of one channel which shares this cube's data '''
+        c = self.channel_idx[channel]
+        baseline, deviation = self.baseline, self.deviation
+        if baseline is not None: baseline = baseline[c:c+1]
+        if deviation is not None: deviation = deviation[:,c:c+1]
+        return PsdCube(self.data[:,c:c+1], [channel], self.times, self.freqs,
+                self.missing, baseline, deviation)
+
+    def get(self, stat, channel, time=None, freq=None):
+        '''
+        Returns a view of the given statistic for one channel: a 2D array
+        with index order [time, frequency], or a 1D array if a time or
+        frequency is given.
+        '''
+        arr = self.data[self.stat_idx[stat], self.channel_idx[channel]]
+        if time is not None: arr = arr[self.time_idx[time]]
+        if freq is not None: arr = arr[..., self.freq_idx[freq]]
+        return arr
+
+    def get_baseline(self, channel):
+        ''' Returns the baseline PSD of one channel, a 1D array of freqs '''
+        if self.baseline is None:
+            self.baseline = get_baseline(self.data[self.stat_idx['MEDIAN']])
+        return self.baseline[self.channel_idx[channel]]
+
+    def get_deviation(self, deviation, channel):
+        '''
+        Returns the absolute ('ABS') or fractional ('FRAC') deviation of the
+        median PSD of one channel from its baseline, a 2D array with index
+        order [time, frequency].
+        '''
+        if self.deviation is None:
+            self.get_baseline(channel)
+            self.deviation = get_deviations(
+                    self.data[self.stat_idx['MEDIAN']], self.baseline)
+        return self.deviation[list(deviations).index(deviation),
+                self.channel_idx[channel]]
+
+    def summarized_freqs(self):
+        '''
+        Returns the frequencies summarized at any time in any channel, as in
+        the index of to_frame(). Reads one channel's median PSD at a time.
+        '''
+        valid = np.zeros(len(self.freqs), dtype=bool)
+        for channel in self.channels:
+            valid |= ~np.isnan(self.get('MEDIAN', channel)).all(axis=0)
+        return self.freqs[valid]
+
+    def valid_times(self, channel):
+        ''' Returns a boolean array of times with any summarized values '''
+        return ~np.isnan(self.get('MEDIAN', channel)).all(axis=1)
+
+def get_cube(run):
+    '''
+    Returns the run's PsdCube, converting it from run.psd_summary the first
+    time it is needed.
+    '''
+    if getattr(run, 'psd_cube', None) is None:
+        run.psd_cube = PsdCube.from_frame(run.psd_summary)
+    return run.psd_cube
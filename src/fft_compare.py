@@ -1,26 +1,26 @@
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 import matplotlib.colors
 import matplotlib.ticker as tkr
 
 import psd
+import store
 import utils
 
 channel = 'y'
 
 ltp = utils.Run('data/ltp/run_b')
-ltpsum = pd.read_pickle(ltp.psd_file)
-ltp.psd_summary = ltpsum[ltpsum.index.get_level_values('TIME') >= 1143962325]
+ltp.time_range = (1143962325, None)
 
 drs = utils.Run('data/drs/run_b')
-drs.psd_summary = pd.read_pickle(drs.psd_file)
+drs.time_range = None
 
 runs = [ltp, drs]
 
 frequencies = np.array([1e-3, 5e-3, 3e-2])
-frequencies = psd.get_exact_freq(ltp.psd_summary, frequencies)
+frequencies = psd.get_exact_freq(store.open_cube(ltp).summarized_freqs(),
+        frequencies)
 
 nrows = len(frequencies)
 ncols = 2
@@ -33,7 +33,8 @@ for r, run in enumerate(runs):
         ax = axes[i, r]
         if i == 0:
             ax.set_title(f'{run.mode.upper()}', fontsize=18)
-        rfftfreq, rfft = psd.fft(run, channel, [freq])
+        rfftfreq, rfft = psd.get_fft(run, channel, [freq],
+                time_range=run.time_range)
         ax.plot(rfftfreq, np.absolute(rfft)**2, color='#0077c8')
         ax.set_yscale('log')
         ax.yaxis.set_minor_locator(tkr.NullLocator())
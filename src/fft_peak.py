@@ -1,10 +1,10 @@
 import os
 
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
 
 import psd
+import store
 import utils
 
 # Plot parameters
@@ -19,60 +19,33 @@ f_step = 5e-6 # amount to step between each check
 min_sig = 3 # minimum significance for peak identification
 
 # Setup
-run.psd_summary = pd.read_pickle(run.psd_file)
+run.psd_cube = store.open_cube(run)
 # Log output file
-log = utils.Log(run.fft_log, f'{run.mode.upper()} {run.name}')
+log = utils.Log(run.fft_log, f'{run.mode.upper()} {run.name}', buffered=True)
 log.log(f'Channel {channel}, %s mHz' % float('%.3g' % (freq[0] * 1000.)))
 log.log(f'Bin width = {bin_width}, peak width = {f_step}, minimum significance = {min_sig}\n')
 # Exact frequency
-freq = psd.get_exact_freq(run.psd_summary, freq)
+freq = psd.get_exact_freq(run.psd_cube.summarized_freqs(), freq)
 # FFT
-rfftfreq, rfft = psd.fft(run, channel, freq, log)
+rfftfreq, rfft = psd.get_fft(run, channel, freq, log)
 fft_psd = np.absolute(rfft)**2
 
-# Number of peak bins to check
-n_bins = int((rfftfreq[-bin_width] - rfftfreq[bin_width]) / f_step)
-# Cycle through frequency space looking for peaks
-f_peaks = []
-peaks = []
-sigs = []
-background = []
-for i in range(n_bins):
-    # Define minimum and maximum peak frequencies
-    f_min = rfftfreq[bin_width] + i * f_step
-    f_max = f_min + f_step
-    
-    # Find background mean and variance
-    b1 = fft_psd[rfftfreq < f_min]
-    bin_width = min(bin_width, b1.shape[0]) # make sure start doesn't go below 0
-    b1 = b1[-bin_width:]
-    b2 = fft_psd[rfftfreq > f_max][:bin_width]
-    b_mean = np.mean(np.concatenate([b1, b2]))
-    b1_var = np.var(b1)
-    b2_var = np.var(b2)
-    b_var = np.mean([b1_var, b2_var])
-    b_std = np.sqrt(b_var)
-    
-    # Find peak value
-    peak_psd = fft_psd[(rfftfreq > f_min) & (rfftfreq < f_max)]
-    peak_range = rfftfreq[(rfftfreq > f_min) & (rfftfreq < f_max)]
-    peak_val = np.max(peak_psd)
-    f_peak = peak_range[np.argmax(peak_psd)]
-    significance = (peak_val - b_mean) / b_std
+# Find peak in every bin, then log each and keep the significant ones
+bins = psd.fft_peaks(rfftfreq, fft_psd, bin_width=bin_width, f_step=f_step,
+        min_sig=None)
+for f_peak, peak_val, significance, b_mean in zip(bins['FREQ'], 
+        bins['AMPLIUDE'], bins['SIG'], bins['BACKGROUND']):
     log.log(f'{f_peak}: {peak_val}, significance {significance} sigma')
     log.log(f'Background level: {b_mean}\n')
-    if significance >= min_sig:
-        f_peaks.append(f_peak)
-        peaks.append(peak_val)
-        sigs.append(significance)
-        background.append(b_mean)
 
 # Significance table
-f_peaks = np.array(f_peaks)
-sig_df = pd.DataFrame({'FREQ': f_peaks, 'PERIOD': 1/f_peaks, 'POWER': peaks, 
-        'SIG': sigs, 'BACKGROUND': background})
+sig_df = bins[bins['SIG'] >= min_sig].rename(columns={'AMPLIUDE': 'POWER'})
+sig_df = sig_df.reset_index(drop=True)
+f_peaks = sig_df['FREQ'].to_numpy()
+peaks = sig_df['POWER'].to_numpy()
 print(sig_df)
 log.log(sig_df.to_string())
+log.close()
 
 # Plot
 plt.plot(rfftfreq[1:], fft_psd[1:])
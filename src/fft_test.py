@@ -1,19 +1,19 @@
 import numpy as np
 from scipy import interpolate
 import matplotlib.pyplot as plt
-import pandas as pd
 
+import psd
+import store
 import utils
 
 #pd.set_option('display.max_rows', 1000)
 
 run = utils.Run('data/drs/run_b')
-summary_file = run.psd_file
-df = pd.read_pickle(summary_file)
 
 # Pick specific frequency and channel
 freq = 0.01038
 channel = run.channels[0]
+df = store.load_psd(run, channel, freq_range=(freq, freq))
 values = df.loc[channel].xs(freq, level='FREQ')['MEDIAN']
 # Remove NaN values
 values = values[values.notna()]
@@ -54,6 +54,11 @@ for kind in interp_types:
     ax2.set_xlabel('Frequency')
     ax2.set_ylabel('FFT')
 
+# Lomb-Scargle periodogram of the original data, for comparison
+ls_power = psd.lomb_scargle(times, values[:,np.newaxis], rfftfreq[1:])
+ax2.plot(rfftfreq[1:], np.sqrt(len(times) * ls_power[:,0]), 
+        label='Lomb-Scargle')
+
 new_values = np.interp(new_times, times, values)
 # Plot interpolated and original data
 handles, labels = ax1.get_legend_handles_labels()
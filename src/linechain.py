@@ -1,18 +1,76 @@
 #!/usr/bin/env python3
 
 import os
+import io
 import sys
 import itertools
 import argparse
 from glob import glob
+from functools import partial
 
 import pandas as pd
 import numpy as np
-from pymc3.stats import hpd
 
-import plot
+import cache
+from checkpoint import Checkpoint, Guard, save_quarantine
+import profiler
 import utils
 
+# Columns and index levels of the linechain summary DataFrame
+summary_cols = ['MEDIAN', 'CI_50_LO', 'CI_50_HI', 'CI_90_LO', 'CI_90_HI']
+summary_levels = ['CHANNEL', 'TIME', 'LINE', 'PARAMETER']
+
+class Linechain:
+    '''
+    A class to store all samples in a linechain file, which is read and
+    parsed only once. Each row holds the model number (i.e., the number of
+    spectral lines) followed by the frequency, amplitude and quality factor
+    of each line. All rows are kept in one 2D array, padded with NaN to the
+    length of the longest row.
+    '''
+    def __init__(self, lc_file):
+        '''
+        Input
+        -----
+          lc_file : string, path to the linechain file
+        '''
+        self.lc_file = lc_file
+        with open(lc_file, 'rb') as f:
+            text = f.read()
+        profiler.add_bytes(len(text))
+        # Count the values in each line from the positions of token starts
+        chars = np.frombuffer(text, dtype=np.uint8)
+        space = chars <= ord(' ')
+        starts = np.flatnonzero(space[:-1] & ~space[1:]) + 1
+        if len(chars) > 0 and not space[0]:
+            starts = np.concatenate([[0], starts])
+        newlines = np.flatnonzero(chars == ord('\n'))
+        row_lengths = np.bincount(np.searchsorted(newlines, starts))
+        row_lengths = row_lengths[row_lengths > 0]
+        # Parse every value in the file at once, splitting on any run of
+        # whitespace as str.split() does, with values rounded as float() does
+        self.values = pd.read_csv(io.BytesIO(text), sep=r'\s+', header=None,
+                names=range(row_lengths.max()), dtype='float64',
+                float_precision='round_trip'
+        ).to_numpy()
+        self.models = self.values[:,0].astype(int)
+        if not np.array_equal(row_lengths, 1 + 3 * self.models):
+            raise ValueError(f'{lc_file} has rows of inconsistent length')
+        # Count how often each model is used
+        self.counts = np.bincount(self.models)
+
+    def params(self, model):
+        '''
+        Returns a 3D array of all line parameters matching the given model,
+        with index order [index, line, parameter].
+        
+        Input
+        -----
+          model : int, model number, must be greater than 0
+        '''
+        params = self.values[self.models == model, 1:1+3*model]
+        return params.reshape(-1, model, 3)
+
 def get_counts(lc_file):
     '''
     Returns a histogram of the counts for each model in the given linechain
@@ -22,17 +80,16 @@ def get_counts(lc_file):
     -----
       lc_file : string, path to the linechain file
     '''
-    with open(lc_file) as lc:
-        # Only use the first column
-        dim = np.array([int(line.split()[0]) for line in lc])
-    
-    # List of unique model numbers through max from lc file
-    dim_u = np.arange(np.max(dim)+1)
-    # Count how often each model is used
-    counts = np.array([len(dim[dim == m]) for m in dim_u])
-    return counts
+    return Linechain(lc_file).counts
 
-def gen_model_df(run, model_file):
+def lc_files(run):
+    ''' Returns a list of all linechain files in a run, by time then channel '''
+    return [os.path.join(time_dir, f'linechain_channel{c}.dat') 
+            for time_dir in run.time_dirs for c in range(len(run.channels))]
+
+@cache.cached(lambda run: (cache.run_key(run), cache.file_key(*lc_files(run))))
+@profiler.timed('linechain best models')
+def get_best_models(run):
     '''
     Returns a DataFrame with times as rows and channels as columns. Cells
     are filled with the most likely model number
@@ -51,6 +108,14 @@ def gen_model_df(run, model_file):
         df.loc[run.gps_times[t], channel] = model
         # Update progress
         p.update(i)
+    return df
+
+def gen_model_df(run, model_file):
+    '''
+    Writes the most likely model number for each time and channel, from
+    get_best_models(), to a CSV file and returns it.
+    '''
+    df = get_best_models(run)
     # Write to CSV
     df.to_csv(model_file, sep=' ')
     return df
@@ -65,22 +130,60 @@ def import_linechain(lc_file, model):
       lc_file : string, path to linechain file
       model : int, preferred model number, must be greater than 0
     '''
-    # Import all rows with dim == model
-    with open(lc_file) as lc:
-        lines = [l.split()[1:] for l in lc if int(l.split()[0]) == model]
+    return Linechain(lc_file).params(model)
+
+def label_lines(freqs, modes, method='harmonic', batch_size=10000):
+    '''
+    Matches the spectral lines in each row to the modal line frequencies.
+    Returns an index array of the same shape as freqs, such that
+    freqs[i, idx[i]] lists the lines of row i in the order of the modes.
     
-    # Configure array
-    line_array = np.array(lines, dtype='float64')
-    # Create 3D array with index order [index, line, parameter]
-    params = []
-    for p in range(3):
-        param = [line_array[:,3*c+p:3*c+p+1] for c in range(model)]
-        params.append(np.hstack(param))
+    Input
+    -----
+      freqs : 2D numpy array, line frequencies with index order [row, line]
+      modes : 1D numpy array, sorted modal frequencies of each line
+      method : string, 'harmonic' to maximize the sum of inverse relative
+               distances between each line and its mode, which lessens the 
+               penalty for one value that doesn't match; or 'sorted' to
+               match lines to modes in order of increasing frequency
+      batch_size : int, number of rows to score at once
+    '''
+    n_rows, model = freqs.shape
+    if method == 'sorted':
+        return np.argsort(freqs, axis=1)
+    elif method != 'harmonic':
+        raise ValueError(f'Unknown line labelling method {method}')
     
-    params = np.dstack(params)
-    return params
+    idx = np.empty((n_rows, model), dtype=int)
+    if model <= 5:
+        # Permutations of line indices; only enumerated for small models,
+        # since there are model! of them
+        perms = np.array(list(itertools.permutations(range(model))))
+    for start in range(0, n_rows, batch_size):
+        f = freqs[start:start+batch_size]
+        # Relative distance between each line and each mode, [row, line, mode]
+        dist = np.abs(f[:,:,np.newaxis] - modes) / modes
+        # Inverse distances, capped so exact matches remain finite
+        score = 1 / np.maximum(dist, 1e-300)
+        if model <= 5:
+            # Score every permutation of each row at once, [row, permutation]
+            sums = score[:, perms, np.arange(model)].sum(axis=2)
+            idx[start:start+len(f)] = perms[sums.argmax(axis=1)]
+            continue
+        # If every line's best mode is a different one, that assignment
+        # maximizes each term of the sum and so is optimal
+        best = score.argmax(axis=2)
+        unique = (np.sort(best, axis=1) == np.arange(model)).all(axis=1)
+        idx[start:start+len(f)][unique] = np.argsort(best[unique], axis=1)
+        # Polynomial time assignment of lines to modes for the other rows
+        from scipy.optimize import linear_sum_assignment
+        for i in np.flatnonzero(~unique):
+            modes_idx, lines_idx = linear_sum_assignment(-score[i].T)
+            idx[start+i] = lines_idx[np.argsort(modes_idx)]
+    return idx
 
-def sort_params(params, log):
+@profiler.timed('linechain sort')
+def sort_params(params, log, method='harmonic'):
     '''
     Sorts the frequencies in the linechain array so that each column corresponds
     to just one spectral line. Returns an array of the same shape as params.
@@ -89,6 +192,7 @@ def sort_params(params, log):
     -----
       params : 3D numpy array, the output of import_linechain()
       log : utils.Log object
+      method : string, line labelling method passed to label_lines()
     '''
     # Calculate modes for each column
     # This should give a rough value for the location of each spectral line
@@ -105,25 +209,12 @@ def sort_params(params, log):
     log.log('Spectral line modal frequencies:')
     log.log(np.array2string(modes, max_line_width=80))
     
-    # Iterate through rows and sort values to correct columns
-    for i, row in enumerate(params):
-        # Compute permutations of all frequencies
-        f = row[:,0]
-        perm = np.array(list(itertools.permutations(f)))
-        # Permutations of indices
-        idx = np.array(list(itertools.permutations(range(len(f)))))
-        # Calculate the distances between each permutation and the modes
-        dist = np.abs(perm - modes) / modes
-        # Compute the total distance magnitudes
-        # Inverting to lessen penalty for one value that doesn't match
-        sums = np.sum(dist ** -1, axis=1) ** -1
-        # Use permutation that minimizes total distance
-        min_idx = idx[sums.argmin()]
-        params[i] = row[min_idx]
-
-    return params
+    # Sort values in each row to the correct columns
+    idx = label_lines(params[:,:,0], modes, method)
+    return np.take_along_axis(params, idx[:,:,np.newaxis], axis=1)
 
-def summarize_linechain(run, time_dir, channel, time_counts, log):
+def summarize_linechain(run, time_dir, channel, chain, log, 
+        sort_method='harmonic'):
     '''
     Returns DataFrame of percentile values for each parameter.
     
@@ -131,15 +222,14 @@ def summarize_linechain(run, time_dir, channel, time_counts, log):
     -----
       time_dir : string, time directory
       channel : str, channel name
-      time_counts : histogram of the number of times each model was chosen for 
-                    this time and channel
+      chain : Linechain object for this time and channel
       log : utils.Log object
+      sort_method : string, line labelling method passed to label_lines()
     '''
     time = run.get_time(time_dir)
-    ch_idx = run.get_channel_index(channel)
     log.log(f'\n-- {time} CHANNEL {channel} --')
-    # Import linechain
-    lc_file = f'{time_dir}linechain_channel{ch_idx}.dat'
+    # Histogram of the number of times each model was chosen
+    time_counts = chain.counts
     # Get preferred model
     model = time_counts.argmax()
     
@@ -148,70 +238,155 @@ def summarize_linechain(run, time_dir, channel, time_counts, log):
     log.log(f'{model} spectral lines found.')
     
     # Initialize summary DataFrame
-    cols = pd.Series(['MEDIAN', 'CI_50_LO', 'CI_50_HI', 'CI_90_LO', 'CI_90_HI'])
     parameters = ['FREQ', 'AMP', 'QF']
-    summary = pd.DataFrame([], columns=cols)
+    summary = pd.DataFrame([], columns=summary_cols)
     
     if model > 0:
-        params = import_linechain(lc_file, model)
+        params = chain.params(model)
         # Line model
         model = params.shape[1]
         # Sort
         if model > 1:
-            params = sort_params(params, log)
+            params = sort_params(params, log, sort_method)
         
-        # HPD
-        median = np.median(params, axis=0).flatten()[:, np.newaxis]
-        hpd_50 = np.vstack(hpd(params, alpha=0.5))
-        hpd_90 = np.vstack(hpd(params, alpha=0.1))
-        stats = np.hstack([median, hpd_50, hpd_90])
+        # Median and HPDs
+        median, hpds = utils.hpd(params, alphas=(0.5, 0.1))
+        stats = np.hstack([
+            median.reshape(-1, 1), hpds[0].reshape(-1, 2), hpds[1].reshape(-1, 2)
+        ])
         midx = pd.MultiIndex.from_product(
             [[channel], [time], list(range(model)), parameters],
-            names=['CHANNEL', 'TIME', 'LINE', 'PARAMETER']
+            names=summary_levels
         )
-        summary = pd.DataFrame(stats, columns=cols, index=midx)
+        summary = pd.DataFrame(stats, columns=summary_cols, index=midx)
         
-        log.log('Line parameter summary:')
-        log.log(summary.to_string(max_cols=80))
+        log.debug('Line parameter summary:')
+        log.debug(lambda: summary.to_string(max_cols=80))
                 
     return summary
 
-def save_summary(run, log_file=None):
+def job_file(run, job):
+    ''' Returns the linechain file of a (channel, time directory) job '''
+    channel, time_dir = job
+    return os.path.join(time_dir, 
+            f'linechain_channel{run.get_channel_index(channel)}.dat')
+
+def job_key(run, sort_method, level, job):
+    ''' Returns a key of the inputs and parameters of summarize_job() '''
+    return (cache.run_key(run), sort_method, level, job, 
+            cache.file_key(job_file(run, job)))
+
+@cache.cached(job_key)
+def summarize_job(run, sort_method, level, job):
+    '''
+    Summarizes the linechain file for one channel and time. Returns the model
+    counts, the summary DataFrame and the log messages, so that jobs can run
+    independently in worker processes.
+    
+    Input
+    -----
+      run : Run object
+      sort_method : string, line labelling method passed to label_lines()
+      level : int, log level
+      job : tuple of channel name and time directory
+    '''
+    channel, time_dir = job
+    log = utils.Log(capture=True, level=level)
+    # Parse linechain file
+    with profiler.stage('linechain import'):
+        chain = Linechain(job_file(run, job))
+    # Spectral line summary statistics
+    with profiler.stage('linechain summary'):
+        summary = summarize_linechain(run, time_dir, channel, chain, log, 
+                sort_method)
+    return chain.counts, summary, log.messages
+
+def save_summary(run, log_file=None, update=False, sort_method='harmonic',
+        jobs=1, verbose=False, resume=False):
     '''
     Returns a summary DataFrame for all linechain files in the given run.
+    The summary of each channel and time is saved to the disk cache (or
+    checkpointed, if the cache is off) as soon as it's done, so an
+    interrupted summary can be resumed. Linechain files which
+    fail, for example because they are corrupt, are left out (their counts
+    are NaN) and listed in a quarantine report instead of stopping the
+    summary.
     
     Input
     -----
       run : Run object
       log_file : string, path to log file (if any)
+      update : bool, only summarize time directories which are new or 
+               modified since the existing summary was generated, and merge
+               them into it
+      sort_method : string, line labelling method passed to label_lines()
+      jobs : int, number of channel and time pairs to summarize in parallel
+      verbose : bool, also log the full summary tables
+      resume : bool, reuse the checkpointed summaries of a previous attempt
+               whose input files haven't changed since
     '''
     # Set up log file
-    log = utils.Log(log_file, f'linechain.py log file for {run.name}')
+    level = utils.DEBUG if verbose else utils.INFO
+    log = utils.Log(log_file, f'linechain.py log file for {run.name}', 
+            level=level, buffered=True)
+    
+    manifest = run.scan_time_dirs('linechain_channel*.dat')
+    time_dirs = run.time_dirs
+    old_counts = None
+    if update and os.path.exists(run.linechain_file) \
+            and os.path.exists(run.linecounts_file) \
+            and os.path.exists(run.linechain_manifest):
+        time_dirs = utils.get_changed_dirs(
+                manifest, pd.read_pickle(run.linechain_manifest))
+        print(f'Found {len(time_dirs)} new or modified time directories.')
+        old_counts = pd.read_pickle(run.linecounts_file)
+        old_summaries = pd.read_pickle(run.linechain_file)
+    times = [run.get_time(d) for d in time_dirs]
     
     # Generate iterable of channels and times
-    all_lc = list(itertools.product(run.channels, run.time_dirs))
+    all_lc = list(itertools.product(run.channels, time_dirs))
+    # Summarize jobs not already checkpointed
+    checkpoint = Checkpoint(run.linechain_checkpoint, resume)
+    keys = [job_key(run, sort_method, level, job) for job in all_lc]
+    todo = [job for job, key in zip(all_lc, keys) if key not in checkpoint]
+    if len(todo) < len(all_lc):
+        print(f'Resuming: {len(all_lc) - len(todo)} channels and times '
+                'already done.')
+    results = utils.imap(Guard(partial(summarize_job, run, sort_method, 
+            level)), todo, jobs=jobs, 
+            message=f'Importing {run.name} linechain...')
     counts = []
     summaries = []
-    # Set up progress indicator
-    p = utils.Progress(all_lc, f'Importing {run.name} linechain...')
-    for i, t in enumerate(all_lc):
-        channel, time_dir = t
-        ch_idx = run.get_channel_index(channel)
-        # Counts for each viable model
-        lc_file = os.path.join(time_dir, f'linechain_channel{ch_idx}.dat')
-        time_counts = get_counts(lc_file)
+    failures = {}
+    failed_dirs = set()
+    for job, key in zip(all_lc, keys):
+        if key in checkpoint:
+            result = checkpoint.load(key)
+        else:
+            result, error = next(results)
+            if error:
+                # Counts of failed files are NaN
+                failures[job_file(run, job)] = error
+                failed_dirs.add(job[1])
+                counts.append([np.nan])
+                continue
+            checkpoint.save(key, result)
+        time_counts, summary, messages = result
         counts.append(time_counts)
-        # Spectral line summary statistics
-        summaries.append(
-            summarize_linechain(run, time_dir, channel, time_counts, log)
-        )
-        # Update progress indicator
-        p.update(i)
+        summaries.append(summary)
+        log.log('\n'.join(messages))
     
     # Combine counts into one DataFrame
     counts = pd.DataFrame(counts, index=pd.MultiIndex.from_product(
-            [run.channels, run.gps_times], names=['CHANNEL', 'TIME']
+            [run.channels, times], names=['CHANNEL', 'TIME']
     ))
+    if old_counts is not None:
+        # Keep unchanged times still in the run, dropping old time gap filler
+        keep_times = set(run.gps_times) - set(times)
+        old_times = old_counts.index.get_level_values('TIME')
+        counts = pd.concat([old_counts[old_times.isin(keep_times)], counts])
+        old_times = old_summaries.index.get_level_values('TIME')
+        summaries.insert(0, old_summaries[old_times.isin(keep_times)])
     # Combine with DataFrame of missing times
     missing = pd.DataFrame(columns=counts.columns, 
         index=pd.MultiIndex.from_product(
@@ -221,24 +396,42 @@ def save_summary(run, log_file=None):
     counts = pd.concat([counts, missing]).sort_index(level=[0, 1])
     counts = counts.astype('float64')
     # Log final output
-    log.log('All line counts:')
-    log.log(counts.to_string(max_cols=80))
+    log.debug('All line counts:')
+    log.debug(lambda: counts.to_string(max_cols=80))
     # Output to file
+    if not os.path.exists(run.summary_dir): os.makedirs(run.summary_dir)
     counts.to_pickle(run.linecounts_file)
     print('Model counts written to ' + run.linecounts_file)
     
     # Combine summaries into one DataFrame
-    summaries = pd.concat(summaries, axis=0)
-    midx = pd.MultiIndex.from_tuples(
-        summaries.index, names=['CHANNEL', 'TIME', 'LINE', 'PARAMETER']
-    )
+    if len(summaries) > 0:
+        summaries = pd.concat(summaries, axis=0)
+        midx = pd.MultiIndex.from_tuples(summaries.index, names=summary_levels)
+    else:
+        # Every job failed, or there was nothing to summarize
+        summaries = pd.DataFrame(columns=summary_cols, dtype='float64')
+        midx = pd.MultiIndex.from_arrays([[]] * len(summary_levels),
+                names=summary_levels)
     summaries.index = midx
+    if old_counts is not None:
+        # Restore the (channel, time) order of a full summary; lexsort is
+        # stable, so lines and parameters keep their order
+        ch_idx = summaries.index.get_level_values('CHANNEL').map(
+                run.get_channel_index)
+        summaries = summaries.iloc[np.lexsort(
+                (summaries.index.get_level_values('TIME'), ch_idx))]
     # Log final output
-    log.log('All summaries:')
-    log.log(summaries.to_string(max_cols=80))
+    log.debug('All summaries:')
+    log.debug(lambda: summaries.to_string(max_cols=80))
     # Output to file
     summaries.to_pickle(run.linechain_file)
     print('Summary written to ' + run.linechain_file)
+    # Leave time directories with failed files out of the manifest so that
+    # updates retry them
+    manifest.drop(list(failed_dirs)).to_pickle(run.linechain_manifest)
+    save_quarantine(run.linechain_quarantine, failures)
+    checkpoint.clear()
+    log.close()
     return counts, summaries
             
 def main():
@@ -253,63 +446,115 @@ def main():
             help='compare summary plots for different runs side by side')
     parser.add_argument('--overwrite-all', dest='overwrite', 
         action='store_true',
-        help='re-generate summary files even if they already exist (default: \
-              ask for each run)'
+        help='re-generate all summaries without using cached results \
+              (default: re-generate using cached results where inputs are \
+              unchanged)'
     )
     parser.add_argument('--keep-all', dest='keep', action='store_true',
-        help='do not generate summary file if it already exists (default: ask \
-              for each run)'
+        help='do not generate summary file if it already exists'
+    )
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+        help='do not read or write the disk cache of intermediate results'
+    )
+    parser.add_argument('--cache-size', dest='cache_size', type=float, 
+        default=10,
+        help='maximum size of the disk cache in GB; least recently used \
+              results are deleted beyond it (default: 10)'
+    )
+    parser.add_argument('-u', '--update', dest='update', action='store_true',
+        help='only summarize time directories which are new or modified since \
+              the existing summary was generated'
+    )
+    parser.add_argument('--resume', dest='resume', action='store_true',
+        help='resume an interrupted summary, reusing the results checkpointed \
+              by the previous attempt (default: start over)'
+    )
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
+        help='write full summary tables to the log file'
+    )
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help='number of channel and time pairs to summarize and plots to \
+              render in parallel (default: 1)'
+    )
+    parser.add_argument('--sort-method', dest='sort_method', 
+        choices=['harmonic', 'sorted'], default='harmonic',
+        help='how to match spectral lines between samples: maximize the sum \
+              of inverse distances to the modal frequencies, or match in \
+              order of frequency (default: harmonic)'
+    )
+    parser.add_argument('--profile', nargs='?', const='stages', 
+        choices=['stages', 'calls'],
+        help='write the wall time, CPU time, bytes read and peak memory of \
+              each stage to linechain_profile.txt in the summary directory, \
+              optionally also profiling all function calls with cProfile to \
+              linechain_profile.prof (default: stages)'
     )
     args = parser.parse_args()
+    cache.configure(size=int(args.cache_size * 2**30), use_cache=args.cache,
+            recompute=args.overwrite)
+    profiler.configure(enable=args.profile is not None, 
+            profile_calls=args.profile == 'calls')
     # Add all runs in data directory if none are specified
     if len(args.runs) == 0: 
         args.runs = glob(f'data{os.sep}*{os.sep}*{os.sep}')
     
     # Initialize run objects; skip missing directories
     runs = utils.init_runs(args.runs)
+    # matplotlib is slow to import, so only load it once it's needed
+    import plot
     
     for run in runs:
         print(f'\n-- {run.mode} {run.name} --')
+        profiler.reset()
         # Log output file
         log_file = os.path.join(run.summary_dir, 'linechain.log')
-        # Confirm to overwrite if summary already exists
-        if args.keep: overwrite = False
-        elif args.overwrite: overwrite = True
-        elif os.path.exists(run.linechain_file):
-            over = input('Found linechain.pkl for this run. Overwrite? (y/N) ')
-            overwrite = True if over == 'y' else False
-        else: overwrite = True
-        
-        if overwrite:
-            run.linecounts, run.lc_summary = save_summary(run, log_file)
-        else:
-            run.lc_summary = pd.read_pickle(run.linechain_file)
-            run.linecounts = pd.read_pickle(run.linecounts_file)
+        with profiler.stage('linechain summaries'):
+            if not (args.keep and os.path.exists(run.linechain_file)):
+                run.linecounts, run.lc_summary = save_summary(run, log_file, 
+                        update=args.update, sort_method=args.sort_method, 
+                        jobs=args.jobs, verbose=args.verbose, 
+                        resume=args.resume)
+            else:
+                run.lc_summary = pd.read_pickle(run.linechain_file)
+                run.linecounts = pd.read_pickle(run.linecounts_file)
+        if args.profile: 
+            profiler.save(run.linechain_profile, f'{run.name} summaries')
         
         if not args.compare:
-            # Plot line parameters
-            print('Plotting...')
-            # Plot linecount colormaps
+            # Plot linecount colormaps and line parameters
+            tasks = []
             for i, channel in enumerate(run.channels):
-                plot_file = os.path.join(run.plot_dir, f'linecounts{i}.png')
-                plot.linecounts_cmap(run, channel, plot_file)
+                ch_run = plot.channel_run(run, channel)
+                tasks.append((os.path.join(run.plot_dir, f'linecounts{i}.png'),
+                        plot.linecounts_cmap, (ch_run, channel), {}))
                 if channel in run.lc_summary.index.unique(level='CHANNEL'):
                     for param in run.lc_summary.index.unique(level='PARAMETER'):
                         plot_file = os.path.join(
                             run.plot_dir, f'linechain_{param.lower()}{i}.png'
                         )
-                        plot.linechain_scatter(
-                            run, channel, param, plot_file=plot_file, show=False
-                        )
+                        tasks.append((plot_file, plot.linechain_scatter, 
+                                (ch_run, channel, param), {}))
+            # Render this run's plots before moving on to the next run
+            profiler.reset()
+            plot.render(tasks, jobs=args.jobs, message='\nPlotting...')
+            if args.profile:
+                profiler.save(run.linechain_profile, f'{run.name} plots', 
+                        append=True)
     
     if args.compare:
-        p = utils.Progress(runs[0].channels, '\nPlotting run comparisons...')
         multirun_dir = os.path.join('out', 'multirun')
         if not os.path.exists(multirun_dir): os.makedirs(multirun_dir)
+        tasks = []
         for i, channel in enumerate(runs[0].channels):
-            plot.compare_linecounts(runs, channel, 
-                    plot_file=os.path.join(multirun_dir, f'linecounts{i}.png'))
-            p.update(i)
+            ch_runs = [plot.channel_run(run, channel) for run in runs]
+            tasks.append((os.path.join(multirun_dir, f'linecounts{i}.png'),
+                    plot.compare_linecounts, (ch_runs, channel), {}))
+        profiler.reset()
+        plot.render(tasks, jobs=args.jobs, message='\nPlotting...')
+        if args.profile:
+            for run in runs:
+                profiler.save(run.linechain_profile, 'Run comparison plots', 
+                        append=True)
     
     print('Done!')
 
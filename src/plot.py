@@ -1,3 +1,7 @@
+import os
+import copy
+import traceback
+
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -5,7 +9,10 @@ import matplotlib.cm as cm
 import matplotlib.colors
 import matplotlib.ticker as tkr
 
+import cube
+import profiler
 import psd
+import store
 import utils
 
 # Font parameters
@@ -69,8 +76,145 @@ def shifted_cmap(cmap, start=0, midpoint=0.5, stop=1.0, name='shiftedcmap'):
     plt.register_cmap(cmap=newcmap)
     return newcmap
 
-def colormap(fig, ax, run, psd, cmap, vlims=None, cbar_label=None, center=None,
-        bar=True):
+def select_channel(df, channel):
+    ''' Returns the rows of a summary DataFrame for one channel '''
+    return df[df.index.get_level_values('CHANNEL') == channel]
+
+class ChannelRun:
+    '''
+    Stand-in for a Run object in plotting tasks, restricted to one channel.
+    It holds only the run's metadata and file paths, so it is cheap to send
+    to a plotting process. Summaries are loaded there from the run's summary
+    files each time a plot function reads them, and only the ones it reads:
+    the PSD store is memory-mapped, and DataFrames hold only this channel.
+    '''
+    # Functions of the run and channel which load each summary
+    loaders = {
+        'psd_cube': lambda run, channel: store.open_cube(run),
+        'psd_summary': lambda run, channel: store.load_psd(run, channel),
+        'linecounts': lambda run, channel: select_channel(
+                pd.read_pickle(run.linecounts_file), channel),
+        'lc_summary': lambda run, channel: select_channel(
+                pd.read_pickle(run.linechain_file), channel),
+    }
+
+    def __init__(self, run, channel):
+        # Leave out summaries already loaded in this process
+        self.run = copy.copy(run)
+        for attr in self.loaders: self.run.__dict__.pop(attr, None)
+        self.channel = channel
+
+    def __getattr__(self, name):
+        # Only called for attributes not set on this object
+        if name.startswith('__') or name in ['run', 'channel']:
+            raise AttributeError(name)
+        if name in self.loaders: return self.loaders[name](self.run, 
+                self.channel)
+        return getattr(self.run, name)
+
+def channel_run(run, channel):
+    '''
+    Returns a ChannelRun of one channel of a run, for plotting tasks. The
+    run's summaries must be saved to its summary files.
+    '''
+    return ChannelRun(run, channel)
+
+def render_task(task):
+    '''
+    Renders one figure with the Agg backend. Returns a tuple of the plot file
+    and the traceback if plotting failed, or None if it succeeded.
+
+    Input
+    -----
+      task : tuple of plot file, plotting function, args and kwargs
+    '''
+    plot_file, func, args, kwargs = task
+    plt.switch_backend('Agg')
+    try:
+        plot_dir = os.path.dirname(plot_file)
+        if plot_dir and not os.path.exists(plot_dir):
+            os.makedirs(plot_dir, exist_ok=True)
+        with profiler.stage(f'plot {func.__name__}'):
+            func(*args, plot_file=plot_file, **kwargs)
+    except Exception:
+        plt.close('all')
+        return plot_file, traceback.format_exc()
+    return plot_file, None
+
+def render(tasks, jobs=1, message='Plotting...'):
+    '''
+    Renders independent figures, spread across a pool of worker processes
+    if jobs > 1. A failed figure doesn't stop the others; returns a dict
+    of failed plot files and their tracebacks.
+
+    Input
+    -----
+      tasks : list of tuples of plot file, plotting function, args and kwargs;
+              args should only include the data needed (see channel_run())
+      jobs : int, number of worker processes
+      message : string, progress indicator status message
+    '''
+    failures = {}
+    for plot_file, error in utils.imap(render_task, tasks, jobs=jobs,
+            message=message):
+        if error: failures[plot_file] = error
+    if len(failures) > 0:
+        print(f'\n{len(failures)} of {len(tasks)} plots failed:')
+        for plot_file, error in failures.items():
+            print(f'  {plot_file}: {error.strip().splitlines()[-1]}')
+    return failures
+
+def bin_mean(arr, starts, axis=0):
+    '''
+    Returns the NaN-ignoring mean of blocks of consecutive entries along one
+    axis of an array. Each block begins at one of the sorted indices in
+    starts.
+    '''
+    valid = ~np.isnan(arr)
+    sums = np.add.reduceat(np.where(valid, arr, 0.), starts, axis=axis)
+    counts = np.add.reduceat(valid, starts, axis=axis)
+    return np.divide(sums, counts, out=np.full(sums.shape, np.nan), 
+            where=counts > 0)
+
+def reduce_colormap(ax, times, freqs, psd, ylim, oversample=2):
+    '''
+    Reduces a PSD colormap to roughly the pixel resolution of the axes, 
+    with a log frequency scale. Frequencies in the same pixel row of the
+    log scale are binned together, then times are binned into blocks no
+    wider than a pixel. Returns a tuple of the time bin edges, frequency bin
+    edges and binned PSD.
+
+    Input
+    -----
+      ax : axes of the plot
+      times : 1D array of times, including the edge after the last time
+      freqs : 1D array of frequencies, including the edge after the last
+      psd : 2D array with index order [frequency, time]
+      ylim : tuple of frequency axis limits
+      oversample : number of bins per pixel
+    '''
+    # Crop frequencies outside the axis limits
+    lo = max(np.searchsorted(freqs, ylim[0], side='right') - 1, 0)
+    hi = np.searchsorted(freqs, ylim[1], side='left')
+    freqs, psd = freqs[lo:hi+1], psd[lo:hi]
+    # Axes size in bins
+    bbox = ax.get_window_extent()
+    width, height = oversample * bbox.width, oversample * bbox.height
+    # Bin frequencies by pixel row, on a log scale
+    pixel = np.floor(np.log(np.maximum(freqs[:-1], ylim[0]) / ylim[0]) 
+            / np.log(ylim[1] / ylim[0]) * height)
+    f_starts = np.flatnonzero(np.diff(pixel, prepend=np.nan) != 0)
+    psd = bin_mean(psd, f_starts)
+    freqs = np.append(freqs[f_starts], freqs[-1])
+    # Bin times
+    t_step = max(int(psd.shape[1] // width), 1)
+    t_starts = np.arange(0, psd.shape[1], t_step)
+    psd = bin_mean(psd, t_starts, axis=1)
+    times = np.append(times[t_starts], times[-1])
+    return times, freqs, psd
+
+def colormap(fig, ax, run, times, freqs, psd, cmap, vlims=None, 
+        cbar_label=None, center=None, bar=True, reduce=True):
     '''
     Function to plot the colormap of a PSD with frequency on the y-axis and
     time on the x-axis.
@@ -78,21 +222,32 @@ def colormap(fig, ax, run, psd, cmap, vlims=None, cbar_label=None, center=None,
     Input
     -----
       fig, ax : The figure and axes of the plot
-      psd : The PSD, an unstacked DataFrame
       run : Run object
+      times : 1D array of GPS times
+      freqs : 1D array of frequencies
+      psd : The PSD, a 2D array with index order [frequency, time]
       cmap : The unaltered color map to use
       vlims : A tuple of the color scale limits
       cbar_label : Color bar label
       center : The center value of a diverging colormap
+      reduce : Bin the PSD to the resolution of the plot before drawing
     '''
+    ylim = (1e-3, 1.)
     # Change columns from GPS time to days elapsed from start of run
-    psd.columns = pd.Series(run.gps2day(psd.columns), name='TIME')
+    days = run.gps2day(times)
     # Median frequency step
-    df = np.median(np.diff(psd.index))
+    df = np.median(np.diff(freqs))
+    # Bin edges
+    days = np.append(days, days[-1] + run.dt / (60*60*24))
+    freqs = np.append(freqs, freqs[-1] + df)
+    if reduce:
+        days, freqs, psd = reduce_colormap(ax, days, freqs, psd, ylim)
     # Auto colormap scale
     if not vlims:
-        med = psd.median(axis=1).median()
-        std = psd.std(axis=1).median()
+        # Skip frequencies with no data
+        rows = psd[~np.isnan(psd).all(axis=1)]
+        med = np.median(np.nanmedian(rows, axis=1))
+        std = np.median(np.nanstd(rows, axis=1, ddof=1))
         vlims = (med - 2 * std, med + 2 * std)
     # Shift colormap to place 0 in the center if needed
     if center:
@@ -101,17 +256,12 @@ def colormap(fig, ax, run, psd, cmap, vlims=None, cbar_label=None, center=None,
             midpoint=(center-vlims[0])/(vlims[1]-vlims[0]), 
             name='shifted colormap'
         )
-    im = ax.pcolormesh(
-        list(psd.columns) + [psd.columns[-1] + run.dt / (60*60*24)],
-        list(psd.index) + [psd.index[-1] + df],
-        psd,
-        cmap=cmap,
-        vmin=vlims[0],
+    im = ax.pcolormesh(days, freqs, psd, cmap=cmap, vmin=vlims[0],
         vmax=vlims[1]
     )
     # Vertical scale
     ax.set_yscale('log')
-    ax.set_ylim(bottom=1e-3, top=1.)
+    ax.set_ylim(bottom=ylim[0], top=ylim[1])
     # Axis labels
     ax.set_xlabel(f'Days elapsed since\n{run.start_date} UTC', 
             fontsize=ax_label_size)
@@ -131,12 +281,12 @@ def colormap(fig, ax, run, psd, cmap, vlims=None, cbar_label=None, center=None,
     
     return im
 
-def all_psds(fig, ax, time_dir, channel, xlim=None, ylim=None):
+def all_psds(fig, ax, run, time_dir, channel, xlim=None, ylim=None):
     '''
     Plots all PSD samples in a single time directory for one channel
     '''
-    df = psd.import_time(time_dir).loc[channel]
-    summary = psd.summarize_psd(time_dir).loc[channel]
+    df = psd.import_time(run, time_dir).loc[channel]
+    summary = psd.summarize_psd(run, time_dir).loc[channel]
     freqs = df.index.get_level_values('FREQ')
     for i in range(100):
         ax.scatter(freqs, df[i], marker='.', color='b')
@@ -184,12 +334,10 @@ def time_slice(fig, ax, time, summary, ylim=None, logpsd=False):
     ax.title.set_text(str(time))
 
 def save_colormaps(run, channel, plot_file, show=False):
-    df = run.psd_summary.loc[channel,'MEDIAN']
-    # Unstack psd, removing all columns except the median
-    unstacked = df.unstack(level='TIME')
-    
-    # Find median across all times
-    median = unstacked.median(axis=1)
+    psd_cube = cube.get_cube(run)
+    # Deviations from median across all times, index order [frequency, time]
+    diff = psd_cube.get_deviation('ABS', channel).T
+    frac = psd_cube.get_deviation('FRAC', channel).T
     # Set up figure
     fig, axs = plt.subplots(1, 2, figsize=(14, 6))
     fig.suptitle(
@@ -200,15 +348,15 @@ def save_colormaps(run, channel, plot_file, show=False):
     axs[0].set_title('Absolute difference from median PSD', 
             fontsize=subplot_title_size, pad=subplot_title_pad)
     axs[0].set_ylabel('Frequency (Hz)', fontsize=ax_label_size)
-    colormap(fig, axs[0], run,
-        unstacked.sub(median, axis=0), 
+    colormap(fig, axs[0], run, psd_cube.times, psd_cube.freqs,
+        diff, 
         cmap=cm.get_cmap('coolwarm'),
         center=0.0
     )
     axs[1].set_title('Fractional difference from median PSD',
             fontsize=subplot_title_size, pad=subplot_title_pad)
-    colormap(fig, axs[1], run,
-        abs(unstacked.sub(median, axis=0)).div(median, axis=0),
+    colormap(fig, axs[1], run, psd_cube.times, psd_cube.freqs,
+        np.abs(frac),
         cmap='PuRd',
         vlims=(0,1)
     )
@@ -228,16 +376,15 @@ def compare_colormaps(runs, channel, plot_file=None, show=False):
         # Setup subplot
         ax = fig.add_subplot(1, len(runs), i+1)
         
-        # Unstack psd, removing all columns except the median
-        df = run.psd_summary.loc[channel,'MEDIAN']
-        unstacked = df.unstack(level='TIME')
-        # Find median across all times
-        median = unstacked.median(axis=1)
+        # Fractional deviation from median across all times, index order
+        # [frequency, time]
+        psd_cube = cube.get_cube(run)
+        frac = psd_cube.get_deviation('FRAC', channel).T
         
         # Subplots
         ax.set_title(f'{run.mode.upper()}', size=subplot_title_size)
-        im = colormap(fig, ax, run,
-            unstacked.sub(median, axis=0).div(median, axis=0), 
+        im = colormap(fig, ax, run, psd_cube.times, psd_cube.freqs,
+            frac, 
             cmap=cm.get_cmap('coolwarm'), vlims=(-1,1),
             center=0.0, bar=False
         )
@@ -527,7 +674,7 @@ def compare_fft(runs, channel, frequencies,
     fig.tight_layout()
     
     for j, run in enumerate(runs):
-        rfftfreq, rfft = psd.fft(run, channel, frequencies)
+        rfftfreq, rfft = psd.get_fft(run, channel, frequencies)
         # Plot highest frequency on top
         frequencies = np.flip(np.sort(frequencies))
         
@@ -0,0 +1,156 @@
+import os
+import time
+import resource
+import cProfile
+import contextlib
+from functools import wraps
+
+import pandas as pd
+
+# Profiler settings, changed with configure(). Stages of the analysis are
+# wrapped in stage(), which does nothing unless profiling is enabled
+enabled = False
+# cProfile.Profile of the main process, if function calls are profiled
+call_profile = None
+# Totals of each stage, in order of first use
+stats = {}
+# Bytes read by each open stage
+_open_stages = []
+
+def configure(enable=None, profile_calls=None):
+    '''
+    Changes the profiler settings. Call before starting worker processes so
+    that they inherit the settings.
+
+    Input
+    -----
+      enable : bool, whether to record stages at all
+      profile_calls : bool, also profile every function call of the main
+                      process with cProfile
+    '''
+    global enabled, call_profile
+    if enable is not None: enabled = enable
+    if profile_calls is not None:
+        call_profile = cProfile.Profile() if profile_calls else None
+    reset()
+
+def reset():
+    ''' Clears all recorded stages and restarts the call profile '''
+    global stats, call_profile
+    stats = {}
+    if call_profile is not None:
+        call_profile.disable()
+        call_profile = cProfile.Profile()
+        call_profile.enable()
+
+def max_rss():
+    ''' Returns the peak resident set size of this process in bytes '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def add(name, calls=0, wall=0., cpu=0., bytes_read=0, peak_rss=0):
+    ''' Adds to the totals of a stage '''
+    total = stats.setdefault(name, {'CALLS': 0, 'WALL': 0., 'CPU': 0.,
+            'BYTES_READ': 0, 'PEAK_RSS': 0})
+    total['CALLS'] += calls
+    total['WALL'] += wall
+    total['CPU'] += cpu
+    total['BYTES_READ'] += bytes_read
+    total['PEAK_RSS'] = max(total['PEAK_RSS'], peak_rss)
+
+def add_bytes(n):
+    ''' Counts bytes read from input files towards all open stages '''
+    for stage_bytes in _open_stages: stage_bytes[0] += n
+
+@contextlib.contextmanager
+def stage(name):
+    '''
+    Context manager which records the wall time, CPU time, bytes read and
+    peak resident set size of a stage of the analysis. Times are summed over
+    all calls of the stage. Stages may be nested, in which case the outer
+    stage includes the inner one.
+    '''
+    if not enabled:
+        yield
+        return
+    stage_bytes = [0]
+    _open_stages.append(stage_bytes)
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        # Remove by identity, since other open stages may have equal counts
+        _open_stages[:] = [b for b in _open_stages if b is not stage_bytes]
+        add(name, calls=1, wall=time.perf_counter() - wall,
+                cpu=time.process_time() - cpu, bytes_read=stage_bytes[0],
+                peak_rss=max_rss())
+
+def timed(name):
+    ''' Decorator which records every call of a function as a stage '''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class Collect:
+    '''
+    Wraps a function to run in a worker process, so that it returns the
+    stages it recorded along with its result. Pass the result to merge() in
+    the main process.
+    '''
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, item):
+        global enabled, stats
+        enabled, stats = True, {}
+        result = self.func(item)
+        return result, stats
+
+def merge(result, worker_stats):
+    ''' Adds the stages of a worker to the totals and returns its result '''
+    for name, total in worker_stats.items():
+        add(name, total['CALLS'], total['WALL'], total['CPU'],
+                total['BYTES_READ'], total['PEAK_RSS'])
+    return result
+
+def table():
+    ''' Returns a DataFrame of the totals of each stage '''
+    df = pd.DataFrame.from_dict(stats, orient='index',
+            columns=['CALLS', 'WALL', 'CPU', 'BYTES_READ', 'PEAK_RSS'])
+    df.index.name = 'STAGE'
+    # Memory in MB
+    df['READ_MB'] = df.pop('BYTES_READ') / 2**20
+    df['PEAK_RSS_MB'] = df.pop('PEAK_RSS') / 2**20
+    return df
+
+def save(profile_file, header='Profile', append=False):
+    '''
+    Writes the totals of each stage to a text file. If function calls are
+    profiled, also writes the call profile since the last reset() next to
+    it, with the extension .prof, for use with pstats or snakeviz; this
+    isn't done when appending, so as not to overwrite an earlier profile.
+
+    Input
+    -----
+      profile_file : string, path to the output file
+      header : string, title written above the table
+      append : bool, add to the end of the file instead of overwriting it
+    '''
+    if len(stats) == 0: return
+    profile_dir = os.path.dirname(profile_file)
+    if profile_dir and not os.path.exists(profile_dir):
+        os.makedirs(profile_dir, exist_ok=True)
+    with open(profile_file, 'a' if append else 'w') as f:
+        f.write(f'{header}\n')
+        f.write('Times in seconds, summed over all calls of each stage and all '
+                'worker processes.\nPeak RSS is the largest of any process.\n')
+        f.write(table().to_string(float_format=lambda x: f'{x:.3f}'))
+        f.write('\n\n')
+    if call_profile is not None and not append:
+        call_profile.disable()
+        call_profile.dump_stats(os.path.splitext(profile_file)[0] + '.prof')
+        call_profile.enable()
+    print(f'Profile written to {profile_file}')
@@ -1,133 +1,325 @@
 #!/usr/bin/env python3
 
 import os
+import io
 from glob import glob
 import sys
 import argparse
+from functools import partial
 
 import numpy as np
 import pandas as pd
-from pymc3.stats import hpd
 
-import linechain as lc
-import plot
+import cache
+from checkpoint import Checkpoint, Guard, save_quarantine
+import cube
+import profiler
+import store
 import utils
 
+def get_chain_files(time_dir):
+    '''
+    Returns a sorted list of all psd.dat files in a time directory.
+    Assumes file name format 'psd.dat.#' and 'psd.dat.##'.
+    '''
+    # Sort so that (for example) psd.dat.2 is sorted before psd.dat.19
+    return sorted(glob(os.path.join(time_dir, 'psd.dat.[0-9]'))) + \
+        sorted(glob(os.path.join(time_dir, 'psd.dat.[0-9][0-9]')))
+
+def read_chains(run, time_dir, batch_size=2**26):
+    '''
+    Reads all psd.dat text files in a single time directory. Returns a tuple
+    of the frequency array and a 3D array of PSD values with index order
+    [chain, frequency, channel]. Files are concatenated and parsed in batches
+    of about batch_size bytes straight into one preallocated array, and the
+    frequency column of every file is checked against the first at once.
+
+    Input
+    -----
+      run : Run object
+      time_dir : relative path to the time directory
+      batch_size : int, number of bytes of text to parse at once
+    '''
+    chain_files = get_chain_files(time_dir)
+    if len(chain_files) == 0:
+        raise FileNotFoundError(f'{time_dir}: no psd.dat files')
+    n_cols = run.channels.shape[0] + 1
+    # Batch number of each file
+    sizes = [os.path.getsize(pf) for pf in chain_files]
+    batches = (np.cumsum(sizes) - sizes) // batch_size
+    chains = None
+    for batch in np.unique(batches):
+        indices = np.flatnonzero(batches == batch)
+        text = []
+        for i in indices:
+            with open(chain_files[i], 'rb') as f:
+                text.append(f.read())
+            # Keep the last row of each file separate from the next file
+            if not text[-1].endswith(b'\n'): text.append(b'\n')
+        text = b''.join(text)
+        profiler.add_bytes(len(text))
+        values = pd.read_csv(io.BytesIO(text), sep=' ', usecols=range(n_cols),
+                header=None, dtype='float64').to_numpy()
+        # Frequencies and array shape are set by the first file
+        if chains is None:
+            n_freqs = len(values) // len(indices)
+            freqs = values[:n_freqs,0]
+            chains = np.empty((len(chain_files), n_freqs, n_cols - 1))
+        if len(values) != len(indices) * n_freqs:
+            raise ValueError(f'{time_dir}: psd.dat files have different '
+                    'numbers of rows')
+        values = values.reshape(len(indices), n_freqs, n_cols)
+        if not np.array_equal(values[:,:,0], np.broadcast_to(freqs, 
+                values.shape[:2])):
+            raise ValueError(f'{time_dir}: psd.dat files have different '
+                    'frequencies')
+        chains[indices] = values[:,:,1:]
+    # Round frequencies to 5 decimals to deal with floating point issues
+    return np.around(freqs, 5), chains
+
+def chain_cache_files(run, time_dir):
+    '''
+    Returns the paths to the binary chain cache of a time directory: the
+    PSD values and the frequencies, in the run's output directory so that
+    the input data is never written to.
+    '''
+    time = run.get_time(time_dir)
+    return (os.path.join(run.chain_dir, f'{time}.npy'),
+            os.path.join(run.chain_dir, f'{time}_freqs.npy'))
+
+def pack_chains(run, time_dir, dtype='float64'):
+    '''
+    Converts all psd.dat text files in a single time directory into a binary
+    chain cache, which import_time() then uses in place of the text files.
+    The PSD values are written to chains/<time>.npy in the run's output
+    directory with index order [chain, frequency, channel] and the
+    frequencies to chains/<time>_freqs.npy.
+
+    Input
+    -----
+      run : Run object
+      time_dir : relative path to the time directory
+      dtype : data type of the cached PSD values, float64 or float32
+    '''
+    freqs, chains = read_chains(run, time_dir)
+    cache_file, freqs_file = chain_cache_files(run, time_dir)
+    if not os.path.exists(run.chain_dir):
+        os.makedirs(run.chain_dir, exist_ok=True)
+    # Write to temporary files first so an interrupted conversion never
+    # leaves a partial cache behind
+    for file, arr in [(freqs_file, freqs), (cache_file, chains.astype(dtype))]:
+        with open(file + '.tmp', 'wb') as f:
+            np.save(f, arr)
+        os.replace(file + '.tmp', file)
+
+def load_chains(run, time_dir):
+    '''
+    Returns a tuple of the frequency array and a 3D array of PSD values with
+    index order [chain, frequency, channel] for a single time directory.
+    Memory-maps the binary chain cache if it exists and is newer than all 
+    psd.dat files; otherwise falls back to reading the text files.
+
+    Input
+    -----
+      run : Run object
+      time_dir : relative path to the time directory
+    '''
+    cache_file, freqs_file = chain_cache_files(run, time_dir)
+    if os.path.exists(cache_file) and os.path.exists(freqs_file):
+        cache_mtime = min(os.path.getmtime(cache_file), 
+                os.path.getmtime(freqs_file))
+        chain_files = get_chain_files(time_dir)
+        if all(os.path.getmtime(pf) <= cache_mtime for pf in chain_files):
+            profiler.add_bytes(os.path.getsize(cache_file))
+            return np.load(freqs_file), np.load(cache_file, mmap_mode='r')
+    return read_chains(run, time_dir)
+
 def import_time(run, time_dir):
     '''
     Import and combine all psd.dat files in a single time directory 
-    for many channels. Assumes file name format 'psd.dat.#' and 'psd.dat.##'.
+    for many channels. Uses the binary chain cache if available.
     Returns a DataFrame with frequency increasing down the rows and 
     chain index increasing across the columns. The DataFrame is MultiIndexed,
     with indices (highest level to lowest) channel, time, frequency.
 
     Input
     -----
+      run : Run object
       time_dir : relative path to the time directory
     '''
     time = run.get_time(time_dir)
-    # Sort so that (for example) psd.dat.2 is sorted before psd.dat.19
-    psd_files = sorted(glob(os.path.join(time_dir, 'psd.dat.[0-9]'))) + \
-        sorted(glob(os.path.join(time_dir, 'psd.dat.[0-9][0-9]')))
-    # Import PSD files into DataFrame
-    time_data = []
-    for pf in psd_files:
-        # Import data file
-        psd = pd.read_csv(
-            pf, sep=' ', usecols=range(run.channels.shape[0]+1), 
-            header=None, index_col=0
-        )
-        # Add index column name
-        psd.index.name = 'FREQ'
-        # Round frequency index to 5 decimals to deal with floating point issues
-        psd.index = np.around(psd.index, 5)
-        # Add channel names
-        psd.columns = pd.Series(run.channels, name='CHANNEL')
-        # Add time level to index
-        psd['TIME'] = time
-        psd.set_index('TIME', append=True, inplace=True)
-        # Concatenate columns vertically
-        psd = psd.stack()
-        time_data.append(psd)
-    # Concatenate psd series horizontally
-    time_data = pd.concat(time_data, axis=1, ignore_index=True)
-    # Reorder and sort multiindex levels
-    time_data = time_data.reorder_levels(['CHANNEL', 'TIME', 'FREQ']).sort_index()
-    # Strip rows of 2s
-    return time_data[time_data.iloc[:,0] < 2]
+    freqs, chains = load_chains(run, time_dir)
+    # Sort channels and frequencies to match the sorted MultiIndex
+    ch_order = np.argsort(run.channels)
+    freq_order = np.argsort(freqs)
+    # Reorder to [channel, frequency, chain]
+    time_data = chains[:,freq_order][:,:,ch_order].transpose(2, 1, 0)
+    # Strip rows of 2s before building the index
+    ch_idx, freq_idx = np.nonzero(time_data[:,:,0] < 2)
+    midx = pd.MultiIndex(
+        levels=[run.channels[ch_order], [time], freqs[freq_order]],
+        codes=[ch_idx, np.zeros_like(ch_idx), freq_idx],
+        names=['CHANNEL', 'TIME', 'FREQ']
+    )
+    return pd.DataFrame(time_data[ch_idx,freq_idx], index=midx)
 
-def summarize_psd(run, time_dir):
+def time_key(run, time_dir):
+    ''' Returns a key of the inputs of summarize_time() for one time '''
+    return (run.channels.tolist(), cache.file_key(*get_chain_files(time_dir), 
+            *chain_cache_files(run, time_dir)))
+
+@cache.cached(time_key)
+def summarize_time(run, time_dir):
     '''
-    Returns a DataFrame with the median and credible intervals for one time.
-    Credible intervals are calculated using
-    pymc3's highest posterior density (HPD) function, where alpha is the 
-    desired probability of type I error (so, 1 - C.I.).
-    Uses the same MultiIndex as import_time().
-    
+    Returns the median and credible intervals of the PSD for one time as a
+    tuple of the sorted frequency array and a 3D array with index order
+    [channel, statistic, frequency], with channels in run.channels order.
+    Credible intervals are calculated using the highest posterior density
+    (HPD), where alpha is the desired probability of type I error 
+    (so, 1 - C.I.). Rows of 2s are set to NaN.
+
     Input
     -----
+      run : Run object
       time_dir : relative path to the time directory
     '''
-    # Import time data
-    time_data = import_time(run, time_dir)
-    # Grab MultiIndex
-    midx = time_data.index
-    # Calculate HPDs
-    time_data_np = time_data.to_numpy().T
-    hpd_50 = hpd(time_data_np, alpha=0.5)
-    hpd_90 = hpd(time_data_np, alpha=0.1)
-    # Return summary DataFrame
-    return pd.DataFrame({
-        'MEDIAN'    : time_data.median(axis=1),
-        'CI_50_LO'  : pd.Series(hpd_50[:,0], index=midx),
-        'CI_50_HI'  : pd.Series(hpd_50[:,1], index=midx),
-        'CI_90_LO'  : pd.Series(hpd_90[:,0], index=midx),
-        'CI_90_HI'  : pd.Series(hpd_90[:,1], index=midx),
-    }, index=midx)
-
-def save_summary(run):
-    '''
-    Returns a multi-index DataFrame of PSD summaries across multiple times 
-    from one run folder. The first index represents channel, the second GPS time
-    and the third frequency. Inserts blank rows in place of time gaps.
+    with profiler.stage('psd import'):
+        freqs, chains = load_chains(run, time_dir)
+        freq_order = np.argsort(freqs)
+        # Index order [chain, frequency, channel]
+        chains = np.asarray(chains)[:,freq_order]
+    # Calculate median and HPDs
+    median, hpds = utils.hpd(chains, alphas=(0.5, 0.1))
+    # Index order [statistic, frequency, channel], as in cube.stats
+    summary = np.stack([median, hpds[0,...,0], hpds[0,...,1], 
+            hpds[1,...,0], hpds[1,...,1]])
+    # Strip rows of 2s
+    summary[:,~(chains[0] < 2)] = np.nan
+    return freqs[freq_order], summary.transpose(2, 0, 1)
+
+def summarize_psd(run, time_dir):
+    '''
+    Returns a DataFrame with the median and credible intervals for one time,
+    as calculated by summarize_time(). Uses the same MultiIndex as 
+    import_time().
     
     Input
     -----
       run : Run object
+      time_dir : relative path to the time directory
     '''
-    # Set up progress indicator
-    p = utils.Progress(run.time_dirs, f'Importing {run.name} psd files...')
-    # Concatenate DataFrames of all times; takes a while
-    summaries = []
-    for i, d in enumerate(run.time_dirs):
-        summaries.append(summarize_psd(run, d))
-        # Update progress indicator
-        p.update(i)
-
-    summaries = pd.concat(summaries)
-
-    # Check for time gaps and fill with NaN DataFrames
-    print('Checking for time gaps...')
-    frequencies = summaries.index.unique(level='FREQ')
+    freqs, summary = summarize_time(run, time_dir)
+    ch_order = np.argsort(run.channels)
+    # Reorder to [channel, frequency, statistic] and flatten the first two axes
+    summary = summary[ch_order].transpose(0, 2, 1).reshape(-1, len(cube.stats))
     midx = pd.MultiIndex.from_product(
-        [run.channels, run.missing_times, frequencies],
+        [run.channels[ch_order], [run.get_time(time_dir)], freqs],
         names=['CHANNEL', 'TIME', 'FREQ']
     )
-    filler = pd.DataFrame(columns=summaries.columns, index=midx)
-    summaries = summaries.append(filler).sort_index(level=[0, 1, 2])
-    print(f'Filled {len(run.missing_times)} missing times with NaN.')
+    summary = pd.DataFrame(summary, index=midx, columns=cube.stats)
+    return summary[summary.notna().any(axis=1)]
+
+def save_summary(run, jobs=1, update=False, resume=False):
+    '''
+    Summarizes the PSDs of all times in one run folder and writes them to
+    the run's summary store in order of GPS time, one time at a time, so
+    that memory use doesn't grow with the length of the run. Time gaps are
+    filled with NaN. Returns the summary as a PsdCube.
+
+    The summary of each time is saved to the disk cache (or checkpointed,
+    if the cache is off) as soon as it's done, so an interrupted summary
+    can be resumed. Times which fail, for example
+    because of a corrupt psd.dat file, are filled with NaN and listed in a
+    quarantine report instead of stopping the summary. Raises ValueError
+    if no time could be summarized.
+    
+    Input
+    -----
+      run : Run object
+      jobs : int, number of time directories to summarize in parallel
+      update : bool, only summarize time directories which are new or 
+               modified since the existing summary was generated, and merge
+               them into it
+      resume : bool, reuse the checkpointed summaries of a previous attempt
+               whose input files haven't changed since
+    '''
+    manifest = run.scan_time_dirs('psd.dat.*')
+    time_dirs = run.time_dirs
+    old_times, old_freqs, old_arrays = None, None, None
+    if update and store.psd_exists(run) and os.path.exists(run.psd_manifest):
+        changed = set(utils.get_changed_dirs(
+                manifest, pd.read_pickle(run.psd_manifest)))
+        time_dirs = [d for d in run.time_dirs if d in changed]
+        print(f'Found {len(time_dirs)} new or modified time directories.')
+        old_times, old_freqs, old_arrays = store.open_psd(run)
+    
+    # Summaries of new times not already checkpointed, in time order
+    checkpoint = Checkpoint(run.psd_checkpoint, resume)
+    keys = {d: (d, time_key(run, d)) for d in time_dirs}
+    todo = [d for d in time_dirs if keys[d] not in checkpoint]
+    if len(todo) < len(time_dirs):
+        print(f'Resuming: {len(time_dirs) - len(todo)} times already done.')
+    summaries = utils.imap(Guard(partial(summarize_time, run)), todo, 
+            jobs=jobs, message=f'Importing {run.name} psd files...')
+    failures = {}
+    times = np.union1d(run.gps_times, run.missing_times)
+    writer = None
+    if old_freqs is not None:
+        writer = store.PsdWriter(run, times, old_freqs)
+    for time_dir in run.time_dirs:
+        time = run.get_time(time_dir)
+        if old_times is None or time_dir in changed:
+            if keys[time_dir] in checkpoint:
+                freqs, summary = checkpoint.load(keys[time_dir])
+            else:
+                result, error = next(summaries)
+                if error:
+                    failures[time_dir] = error
+                    continue
+                checkpoint.save(keys[time_dir], result)
+                freqs, summary = result
+        else:
+            # Copy unchanged time from the existing summary
+            t = np.searchsorted(old_times, time)
+            if t == len(old_times) or old_times[t] != time: continue
+            freqs, summary = old_freqs, np.stack([arr[t] for arr in old_arrays])
+        # Frequency axis is set by the first time
+        with profiler.stage('psd write'):
+            if writer is None: writer = store.PsdWriter(run, times, freqs)
+            writer.write(time, freqs, summary)
+    print(f'Filled {len(run.missing_times) + len(failures)} missing times '
+            'with NaN.')
+    
+    if not os.path.exists(run.summary_dir): os.makedirs(run.summary_dir)
+    if writer is None:
+        # Nothing set the frequency axis, so there is no summary to write
+        save_quarantine(run.psd_quarantine, failures)
+        raise ValueError(f'{run.name}: no time directory could be '
+                f'summarized, see {run.psd_quarantine}')
     
     # Output to file
-    print(f'Writing to {run.psd_file}...')
-    summaries.to_pickle(run.psd_file)
-    return summaries
+    print(f'Writing to {run.psd_store}...')
+    old_arrays = None
+    with profiler.stage('psd write'):
+        writer.close()
+    # Leave failed times out of the manifest so that updates retry them
+    manifest.drop(list(failures)).to_pickle(run.psd_manifest)
+    save_quarantine(run.psd_quarantine, failures)
+    checkpoint.clear()
+    return store.open_cube(run)
 
-def get_exact_freq(summary, approx_freqs):
+def get_exact_freq(freqs, approx_freqs):
     '''
     Takes an approximate input frequency and returns the closest measured
     frequency in the data.
+
+    Input
+    -----
+      freqs : sorted array of the summary's frequencies, as returned by
+              PsdCube.summarized_freqs()
+      approx_freqs : array of approximate frequencies
     '''
-    freqs = np.array(sorted(summary.index.unique(level='FREQ')))
+    freqs = np.asarray(freqs)
     freq_indices = np.round(
             approx_freqs / (np.max(freqs) - np.min(freqs)) * len(freqs)
     ).astype(int)
@@ -139,36 +331,243 @@ def get_impacts(impacts_file):
     impacts = pd.read_csv(impacts_file, sep=' ', names=cols, na_values='-')
     return impacts
 
-def fft(run, channel, frequencies, log=None):
+def lomb_scargle(times, values, freqs, chunk_size=256):
+    '''
+    Returns the Lomb-Scargle periodogram of several time series sampled at
+    the same irregular times, with index order [frequency, series]. Uses the
+    PSD normalization, so for evenly sampled data the periodogram is
+    |DFT|^2 / N. The trigonometric terms at each frequency are computed once
+    and shared by all series. NaN values are replaced by the series mean.
+
+    This is the exact periodogram, evaluated directly: it costs
+    O(N * F) time for N times and F frequencies, plus O(N * F) per series.
+    For long runs, use lomb_scargle_fast() instead.
+
+    Input
+    -----
+      times : 1D array of sample times
+      values : 2D array with index order [time, series]
+      freqs : 1D array of positive frequencies
+      chunk_size : int, number of frequencies to compute at once
+    '''
+    # Center each series
+    y = np.nan_to_num(values - np.nanmean(values, axis=0))
+    t = times - times[0]
+    power = np.empty((len(freqs), y.shape[1]))
+    for i in range(0, len(freqs), chunk_size):
+        omega = 2 * np.pi * freqs[i:i+chunk_size]
+        omega_t = np.outer(t, omega)
+        # Time offset which makes the sine and cosine terms orthogonal
+        tau = np.arctan2(np.sin(2 * omega_t).sum(axis=0), 
+                np.cos(2 * omega_t).sum(axis=0)) / (2 * omega)
+        cos = np.cos(omega_t - omega * tau)
+        sin = np.sin(omega_t - omega * tau)
+        power[i:i+chunk_size] = 0.5 * (
+            (cos.T @ y)**2 / (cos**2).sum(axis=0)[:,np.newaxis]
+            + (sin.T @ y)**2 / (sin**2).sum(axis=0)[:,np.newaxis]
+        )
+    return power
+
+def grid_positions(x, n_grid):
+    '''
+    Returns the index of the nearest point of a periodic grid of n_grid
+    points to each position x, and the offset of x from that point, which is
+    between -0.5 and 0.5.
+    '''
+    nearest = np.rint(x)
+    return nearest.astype(int) % n_grid, x - nearest
+
+def trig_sums(t, h, f0, df, n_freqs, oversampling=2, tolerance=1e-14):
+    '''
+    Returns the sums of h * exp(2 pi i f t) over the times t at the regular
+    frequencies f = f0 + k * df, k = 0..n_freqs-1, with index order
+    [frequency, series].
+
+    Each time is placed on the nearest point of a regular grid, and the
+    phase error of that shift is expanded in a Taylor series, so the sums
+    are a weighted sum of FFTs of the grid times powers of the offsets
+    (the low-rank approach of Ruiz-Antolin & Townsend 2018). The expansion
+    is centered on the middle frequency and taken to enough terms that the
+    error is below tolerance times the sum of |h|. The grid positions depend
+    only on the times, so they are shared by all series.
+
+    Input
+    -----
+      t : 1D array of times, starting at 0
+      h : 2D array with index order [time, series]
+      f0, df : first frequency and frequency step
+      n_freqs : int, number of frequencies
+      oversampling : int, grid points per frequency
+      tolerance : float, error bound relative to the sum of |h|
+    '''
+    # Grid size: power of 2 at least oversampling times the frequencies
+    n_grid = 2 ** int(np.ceil(np.log2(oversampling * n_freqs)))
+    indices, offsets = grid_positions(t * df * n_grid, n_grid)
+    # Frequency steps from the middle frequency, in cycles per grid point
+    center = n_freqs // 2
+    steps = (np.arange(n_freqs) - center) / n_grid
+    # Each Taylor term is at most x^p / p!, where |x| = pi * n_freqs / n_grid
+    x_max = np.pi * max(n_freqs - center, center) / n_grid
+    # Shift to the first and middle frequencies before placing on the grid
+    h = h * np.exp(2j * np.pi * (f0 * t + center * offsets / n_grid)
+            )[:,np.newaxis]
+    sums = np.zeros((n_freqs, h.shape[1]), dtype=complex)
+    term, bound = np.ones(n_freqs), 1.
+    for p in range(64):
+        grid = np.zeros((n_grid, h.shape[1]), dtype=complex)
+        np.add.at(grid, indices, h)
+        sums += term[:,np.newaxis] * (n_grid * np.fft.ifft(grid, axis=0)
+                )[:n_freqs]
+        if bound < tolerance: break
+        # Next term: multiply by 2 pi i * step * offset / (p + 1)
+        h = h * offsets[:,np.newaxis]
+        term = term * 2j * np.pi * steps / (p + 1)
+        bound *= x_max / (p + 1)
+    return sums
+
+def lomb_scargle_fast(times, values, freqs, chunk_size=64, oversampling=2,
+        tolerance=1e-14):
+    '''
+    Returns lomb_scargle() for a regular grid of frequencies, computed with
+    FFTs in the manner of Press & Rybicki (1989): the sums over time at all
+    frequencies come from FFTs of the data placed on a regular grid (see
+    trig_sums()). This costs O(N + F log F) per series, for N times and F
+    frequencies, instead of O(N * F), and matches lomb_scargle() to about
+    1e-10 relative error. The grid positions depend only on the times, so
+    they are computed once for all series.
+
+    Input
+    -----
+      times : 1D array of sample times
+      values : 2D array with index order [time, series]
+      freqs : 1D array of positive, evenly spaced frequencies
+      chunk_size : int, number of series to compute at once
+      oversampling : int, grid points per frequency
+      tolerance : float, error bound of the sums relative to sum of |values|
+    '''
+    f0 = freqs[0]
+    df = freqs[1] - freqs[0] if len(freqs) > 1 else freqs[0]
+    if not np.allclose(np.diff(freqs), df):
+        raise ValueError('Frequencies must be evenly spaced')
+    # Center each series
+    y = np.nan_to_num(values - np.nanmean(values, axis=0))
+    t = times - times[0]
+    # Sums of cos(2 omega t) and sin(2 omega t), shared by all series
+    trig2 = trig_sums(t, np.ones((len(t), 1)), 2 * f0, 2 * df, len(freqs),
+            oversampling, tolerance)[:,0]
+    # Cosine and sine of 2 omega tau, where tau is the time offset which
+    # makes the sine and cosine terms orthogonal
+    norm = np.maximum(np.absolute(trig2), 1e-300)
+    cos2, sin2 = trig2.real / norm, trig2.imag / norm
+    cos_tau = np.sqrt(0.5 * (1 + cos2))
+    sin_tau = np.sign(sin2) * np.sqrt(0.5 * (1 - cos2))
+    # Sums of cos^2 and sin^2 of omega (t - tau)
+    cc = 0.5 * (len(t) + trig2.real * cos2 + trig2.imag * sin2)
+    ss = len(t) - cc
+    power = np.empty((len(freqs), y.shape[1]))
+    for i in range(0, y.shape[1], chunk_size):
+        trig = trig_sums(t, y[:,i:i+chunk_size], f0, df, len(freqs),
+                oversampling, tolerance)
+        # Sums of y cos(omega (t - tau)) and y sin(omega (t - tau))
+        yc = trig.real * cos_tau[:,np.newaxis] \
+                + trig.imag * sin_tau[:,np.newaxis]
+        ys = trig.imag * cos_tau[:,np.newaxis] \
+                - trig.real * sin_tau[:,np.newaxis]
+        power[:,i:i+chunk_size] = 0.5 * (yc**2 / cc[:,np.newaxis] 
+                + ys**2 / ss[:,np.newaxis])
+    return power
+
+def fft_key(run, channel, frequencies=None, log=None, method='interp', 
+        time_range=None):
+    ''' Returns the cache key of fft(): the summary content and parameters '''
+    freqs_key = None if frequencies is None else cache.array_key(frequencies)
+    return (store.median_hash(run, channel, time_range), freqs_key, method)
+
+def time_grid(times):
+    '''
+    Returns the mean time difference between observations, excluding
+    outliers, and the number of evenly spaced times at that cadence which
+    span the observations. These set the FFT frequencies.
     '''
-    Returns the discrete Fourier transform of power at specific frequencies
-    over time. First interpolates the data to get consistent dt.
-    '''
-    if log: log.log('FFT analysis')
-    # Select median column for specific run, channel
-    df = run.psd_summary.loc[channel,'MEDIAN']
-    # Remove NaN values
-    df = df[df.notna()]
-    times = df.index.unique(level='TIME')
     # Find time differences between each observation
-    diffs = np.array([times[i] - times[i-1] for i in range(1, len(times))])
+    diffs = np.diff(times)
     # Find the mean time difference, excluding outliers
     dt = np.mean(diffs[diffs < 1640])
+    # Number of times at same time cadence
+    n = int((times[-1] - times[0]) / dt)
+    return dt, n
+
+@cache.cached(fft_key)
+@profiler.timed('fft')
+def fft(run, channel, frequencies=None, log=None, method='interp', 
+        time_range=None):
+    '''
+    Returns the discrete Fourier transform of power at specific frequencies
+    over time. By default, first interpolates the data to get consistent dt.
+    All frequencies are transformed together. The median PSD is read from
+    the run's summary store.
+
+    The 'lombscargle' method instead computes the Lomb-Scargle periodogram
+    of the irregularly sampled data, so time gaps are not filled in. It is
+    evaluated at the same FFT frequencies and returned as the amplitude
+    sqrt(N * P), which matches the FFT amplitude for evenly sampled data.
+    'lombscargle' evaluates the periodogram exactly, at O(N * F) cost for N
+    times and F FFT frequencies; 'lombscargle-fast' computes the same
+    periodogram with FFTs, at O(N + F log F) cost per series (see
+    lomb_scargle_fast()).
+
+    Input
+    -----
+      run : Run object
+      channel : string, channel name
+      frequencies : array of exact frequencies (default: all frequency bins)
+      log : Log object, optional
+      method : 'interp', 'lombscargle' or 'lombscargle-fast'
+      time_range : tuple of inclusive GPS time bounds; either can be None
+    
+    Returns a tuple of FFT frequencies and FFT amplitudes, each with index
+    order [frequency, FFT frequency], or 1D if only one frequency is given.
+    '''
+    if log: log.log(f'FFT analysis ({method})')
+    # Select median values for specific run, channel
+    times, freqs, median = store.open_median(run, channel, time_range)
+    if frequencies is None: frequencies = freqs
+    freq_idx = {f: i for i, f in enumerate(freqs)}
+    freq_indices = [freq_idx[f] for f in frequencies]
+    # Remove times with NaN values
+    valid = ~np.isnan(median).all(axis=1)
+    times = times[valid]
+    median = median[valid][:,freq_indices]
+    dt, n = time_grid(times)
     if log:
         log.log(f'dt = {dt}')
         log.log(f'1/(2*dt) = {1. / (2 * dt)}')
     
-    # List of times at same time cadence
-    n = int((times[-1] - times[0]) / dt)
-    new_times = np.array([times[0] + i * dt for i in range(n)])
-    
-    rfftfreq = []
-    rfft = []
-    for f in frequencies:
-        median = df.xs(f, level='FREQ')
-        new_values = np.interp(new_times, times, median)
-        rfftfreq.append(np.fft.rfftfreq(n, dt))
-        rfft.append(np.absolute(np.fft.rfft(new_values)))
+    if method == 'interp':
+        # List of times at same time cadence
+        new_times = times[0] + np.arange(n) * dt
+        # Linear interpolation onto new times, as in np.interp, for all
+        # frequencies at once: index of the observation before each new time
+        before = np.searchsorted(times, new_times, side='right') - 1
+        before = np.clip(before, 0, len(times) - 2)
+        slope = (median[before+1] - median[before]) \
+                / (times[before+1] - times[before])[:,np.newaxis]
+        new_values = slope * (new_times - times[before])[:,np.newaxis] \
+                + median[before]
+        # Transform along the time axis; reorder to [frequency, FFT frequency]
+        rfft = np.absolute(np.fft.rfft(new_values, axis=0)).T
+    elif method in ['lombscargle', 'lombscargle-fast']:
+        ls_freqs = np.fft.rfftfreq(n, dt)[1:]
+        if method == 'lombscargle':
+            power = lomb_scargle(times, median, ls_freqs).T
+        else:
+            power = lomb_scargle_fast(times, median, ls_freqs).T
+        # Zero frequency term is the sum of the series, as in the FFT
+        dc = np.absolute(np.nansum(median, axis=0))[:,np.newaxis]
+        rfft = np.hstack([dc, np.sqrt(len(times) * power)])
+    else:
+        raise ValueError(f'Unknown FFT method {method}')
+    rfftfreq = np.broadcast_to(np.fft.rfftfreq(n, dt), rfft.shape)
     
     if len(frequencies) == 1:
         rfftfreq = rfftfreq[0]
@@ -176,49 +575,133 @@ def fft(run, channel, frequencies, log=None):
     
     return rfftfreq, rfft
     
-def fft_peaks(rfftfreq, rfft):
-    # Analysis parameters
-    bin_width = 10 # number of points on either side of peak to bin
-    f_step = 5e-6 # amount to step between each check
-    min_sig = 3 # minimum significance for peak identification
+def save_fft(run, channel, chunk_size=256, log=None, time_range=None):
+    '''
+    Computes the FFT over time of every frequency bin of one channel and
+    saves it to the run's FFT store, unless the store already has it for
+    the current summary. Returns the summary's content hash, under which the
+    FFT is saved.
+
+    Input
+    -----
+      run : Run object
+      channel : string, channel name
+      chunk_size : int, number of frequency bins to transform at once
+      log : Log object, optional
+      time_range : tuple of inclusive GPS time bounds; either can be None
+    '''
+    key = store.median_hash(run, channel, time_range)
+    if store.load_fft(run, key) is not None:
+        if log: log.log(f'Found FFT of channel {channel} in {run.fft_store}')
+        return key
+    times, freqs, median = store.open_median(run, channel, time_range)
+    dt, n = time_grid(times[~np.isnan(median).all(axis=1)])
+    # Bypass the disk cache, since the FFT store already persists the result
+    transform = fft.__wrapped__
+    with profiler.stage('fft store'):
+        chunks = (np.atleast_2d(transform(run, channel, 
+                freqs[i:i+chunk_size], time_range=time_range)[1])
+                for i in range(0, len(freqs), chunk_size))
+        store.save_fft(run, key, np.fft.rfftfreq(n, dt), chunks, len(freqs))
+    return key
+
+def save_ffts(run, log=None):
+    '''
+    Saves the FFT over time of every channel and frequency bin of a run,
+    and deletes FFTs of outdated summaries.
+    '''
+    keys = [save_fft(run, channel, log=log) for channel in run.channels]
+    store.prune_fft(run, keys)
+
+def get_fft(run, channel, frequencies=None, log=None, time_range=None):
+    '''
+    Returns the FFT over time at specific frequencies from the run's FFT
+    store, computing and saving the FFT of every frequency bin first if
+    needed. Output is the same as fft().
+    '''
+    rfftfreq, rfft = store.load_fft(run, save_fft(run, channel, log=log, 
+            time_range=time_range))
+    times, freqs, arrays = store.open_psd(run)
+    if frequencies is None: frequencies = freqs
+    freq_idx = {f: i for i, f in enumerate(freqs)}
+    rfft = rfft[[freq_idx[f] for f in frequencies]]
+    rfftfreq = np.broadcast_to(rfftfreq, rfft.shape)
+    
+    if len(frequencies) == 1:
+        rfftfreq = rfftfreq[0]
+        rfft = rfft[0]
     
+    return rfftfreq, rfft
+
+@cache.cached(lambda rfftfreq, rfft, bin_width=10, f_step=5e-6, min_sig=3: 
+        (cache.array_key(rfftfreq, rfft), bin_width, f_step, min_sig))
+@profiler.timed('fft peaks')
+def fft_peaks(rfftfreq, rfft, bin_width=10, f_step=5e-6, min_sig=3):
+    '''
+    Returns a DataFrame of significant peaks in an FFT. Steps through 
+    frequency space in bins of width f_step, comparing the maximum in each
+    bin to the mean and standard deviation of the background on either side.
+    All bins are evaluated at once.
+    
+    Input
+    -----
+      rfftfreq : 1D array of FFT frequencies, sorted
+      rfft : 1D array of FFT values
+      bin_width : int, number of points on either side of peak to bin
+      f_step : float, amount to step between each check
+      min_sig : float, minimum significance for peak identification, or
+                None to return the peak of every bin
+    '''
+    rfftfreq = np.asarray(rfftfreq)
+    rfft = np.asarray(rfft, dtype='float64')
     # Number of peak bins to check
     n_bins = int((rfftfreq[-bin_width] - rfftfreq[bin_width]) / f_step)
-    # Cycle through frequency space looking for peaks
-    f_peaks = []
-    peaks = []
-    sigs = []
-    background = []
-    for i in range(n_bins):
-        # Define minimum and maximum peak frequencies
-        f_min = rfftfreq[bin_width] + i * f_step
-        f_max = f_min + f_step
-        
-        # Find background mean and variance
-        b1 = rfft[rfftfreq < f_min]
-        bin_width = min(bin_width, b1.shape[0]) # make sure start doesn't go below 0
-        b1 = b1[-bin_width:]
-        b2 = rfft[rfftfreq > f_max][:bin_width]
-        b_mean = np.mean(np.concatenate([b1, b2]))
-        b_var = np.mean([np.var(b1), np.var(b2)])
-        b_std = np.sqrt(b_var)
-        
-        # Find peak value
-        peak_psd = rfft[(rfftfreq > f_min) & (rfftfreq < f_max)]
-        peak_range = rfftfreq[(rfftfreq > f_min) & (rfftfreq < f_max)]
-        peak_val = np.max(peak_psd)
-        f_peak = peak_range[np.argmax(peak_psd)]
+    # Minimum and maximum frequencies of each bin
+    f_min = rfftfreq[bin_width] + np.arange(n_bins) * f_step
+    f_max = f_min + f_step
+    # Bins are open intervals: index of first point above f_min and first
+    # point at or above f_max
+    start = np.searchsorted(rfftfreq, f_min, side='right')
+    stop = np.searchsorted(rfftfreq, f_max, side='left')
+    # Skip bins which contain no points
+    nonempty = stop > start
+    f_min, f_max = f_min[nonempty], f_max[nonempty]
+    start, stop = start[nonempty], stop[nonempty]
+    
+    # Find background mean and variance from windows of bin_width points
+    # below f_min and above f_max; pad with NaN in case they run off the ends
+    padded = np.concatenate([
+        np.full(bin_width, np.nan), rfft, np.full(bin_width, np.nan)
+    ])
+    windows = np.lib.stride_tricks.as_strided(padded, 
+        shape=(len(padded) - bin_width + 1, bin_width),
+        strides=(padded.strides[0], padded.strides[0]), writeable=False
+    )
+    b1 = windows[np.searchsorted(rfftfreq, f_min, side='left')]
+    b2 = windows[np.searchsorted(rfftfreq, f_max, side='right') + bin_width]
+    with np.errstate(invalid='ignore'):
+        b_mean = np.nanmean(np.hstack([b1, b2]), axis=1)
+        b_var = (np.nanvar(b1, axis=1) + np.nanvar(b2, axis=1)) / 2
+    b_std = np.sqrt(b_var)
+    
+    # Find peak value in each bin, padding bins to the widest one
+    idx = start[:, np.newaxis] + np.arange(max(np.max(stop - start, initial=0), 1))
+    in_bin = idx < stop[:, np.newaxis]
+    peak_psd = np.where(in_bin, rfft[np.minimum(idx, len(rfft) - 1)], -np.inf)
+    peak_idx = idx[np.arange(len(idx)), peak_psd.argmax(axis=1)]
+    peak_val = rfft[peak_idx]
+    with np.errstate(invalid='ignore', divide='ignore'):
         significance = (peak_val - b_mean) / b_std
-        if significance >= min_sig:
-            f_peaks.append(f_peak)
-            peaks.append(peak_val)
-            sigs.append(significance)
-            background.append(b_mean)
-
+    
     # Significance table
-    f_peaks = np.array(f_peaks)
+    if min_sig is None:
+        sig = np.ones(len(significance), dtype=bool)
+    else:
+        sig = significance >= min_sig
+    f_peaks = rfftfreq[peak_idx][sig]
     peak_df = pd.DataFrame({'FREQ': f_peaks, 'PERIOD': 1/f_peaks, 
-            'AMPLIUDE': peaks, 'SIG': sigs, 'BACKGROUND': background})
+            'AMPLIUDE': peak_val[sig], 'SIG': significance[sig], 
+            'BACKGROUND': b_mean[sig]})
     
     return peak_df
 
@@ -232,21 +715,64 @@ def main():
     )
     parser.add_argument('-c', '--compare', dest='compare', action='store_true',
             help='compare summary plots for different runs side by side')
-    parser.add_argument('--overwrite-all', dest='overwrite', action='store_true',
-        help='re-generate summary files even if they already exist (default: \
-              ask for each run)'
+    parser.add_argument('--overwrite-all', dest='overwrite', 
+        action='store_true',
+        help='re-generate all summaries without using cached results \
+              (default: re-generate using cached results where inputs are \
+              unchanged)'
     )
     parser.add_argument('--keep-all', dest='keep', action='store_true',
-        help='do not generate summary file if it already exists (default: ask \
-              for each run)'
+        help='do not generate summary file if it already exists'
+    )
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+        help='do not read or write the disk cache of intermediate results'
+    )
+    parser.add_argument('--cache-size', dest='cache_size', type=float, 
+        default=10,
+        help='maximum size of the disk cache in GB; least recently used \
+              results are deleted beyond it (default: 10)'
+    )
+    parser.add_argument('-v', '--verbose', dest='verbose', action='store_true',
+        help='write detailed output to the log file'
+    )
+    parser.add_argument('-u', '--update', dest='update', action='store_true',
+        help='only summarize time directories which are new or modified since \
+              the existing summary was generated'
+    )
+    parser.add_argument('--resume', dest='resume', action='store_true',
+        help='resume an interrupted summary, reusing the results checkpointed \
+              by the previous attempt (default: start over)'
+    )
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help='number of time directories to summarize and plots to render in \
+              parallel (default: 1)'
+    )
+    parser.add_argument('--pack-chains', dest='pack', nargs='?', 
+        const='float64', choices=['float32', 'float64'],
+        help='convert psd.dat files to a binary chain cache before \
+              summarizing, optionally specifying the data type \
+              (default: float64)'
+    )
+    parser.add_argument('--profile', nargs='?', const='stages', 
+        choices=['stages', 'calls'],
+        help='write the wall time, CPU time, bytes read and peak memory of \
+              each stage to psd_profile.txt in the summary directory, \
+              optionally also profiling all function calls with cProfile to \
+              psd_profile.prof (default: stages)'
     )
     args = parser.parse_args()
+    cache.configure(size=int(args.cache_size * 2**30), use_cache=args.cache,
+            recompute=args.overwrite)
+    profiler.configure(enable=args.profile is not None, 
+            profile_calls=args.profile == 'calls')
     # Add all runs in data directory if none are specified
     if len(args.runs) == 0: 
         args.runs = glob(f'data{os.sep}*{os.sep}*{os.sep}')
     
     # Initialize run objects; skip missing directories
     runs = utils.init_runs(args.runs)
+    # matplotlib is slow to import, so only load it once it's needed
+    import plot
     
     # Import impacts file, if any
     impacts_file = 'impacts.dat'
@@ -256,28 +782,38 @@ def main():
     
     for run in runs:
         print(f'\n-- {run.mode} {run.name} --')
+        profiler.reset()
         # Log output file
         log_file = os.path.join(run.summary_dir, 'psd.log')
-        log = utils.Log(log_file, f'psd.py log file for {run.name}')
-        # Confirm to overwrite if summary already exists
-        if args.keep: overwrite = False
-        elif args.overwrite: overwrite = True
-        elif os.path.exists(run.psd_file):
-            over = input('Found psd.pkl for this run. Overwrite? (y/N) ')
-            overwrite = True if over == 'y' else False
-        else: overwrite = True
-
-        # Import / generate summary PSD DataFrame
-        if overwrite:
-            run.psd_summary = save_summary(run)
-        else:
-            run.psd_summary = pd.read_pickle(run.psd_file)
+        log = utils.Log(log_file, f'psd.py log file for {run.name}', 
+                level=utils.DEBUG if args.verbose else utils.INFO, 
+                buffered=True)
+        # Convert chain text files to binary cache
+        if args.pack:
+            for _ in utils.imap(partial(pack_chains, run, dtype=args.pack),
+                    run.time_dirs, jobs=args.jobs,
+                    message=f'Packing {run.name} psd files...'):
+                pass
+        # Import / generate summary PSD store. Channels are only read from
+        # it when a plot needs them
+        with profiler.stage('psd summaries'):
+            if not (args.keep and store.psd_exists(run)):
+                run.psd_cube = save_summary(run, jobs=args.jobs, 
+                        update=args.update, resume=args.resume)
+            else:
+                run.psd_cube = store.open_cube(run)
+        
+        # FFT over time of every frequency bin
+        print('Saving FFTs...')
+        save_ffts(run, log)
+        if args.profile: 
+            profiler.save(run.psd_profile, f'{run.name} summaries')
         
         # Make plots
-        df = run.psd_summary
         # Frequency slices: roughly logarithmic, low-frequency
         plot_frequencies = np.array([1e-3, 3e-3, 5e-3, 1e-2, 3e-2, 5e-2])
-        plot_frequencies = get_exact_freq(run.psd_summary, plot_frequencies)
+        plot_frequencies = get_exact_freq(run.psd_cube.summarized_freqs(),
+                plot_frequencies)
         # Time slices: get even spread of times
         n = 6
         indices = [int(i / (n-1) * len(run.gps_times)) for i in range(1,n-1)]
@@ -286,42 +822,56 @@ def main():
         )
         
         if not args.compare:
-            p = utils.Progress(run.channels, 'Plotting...')
+            tasks = []
             for i, channel in enumerate(run.channels):
+                ch_run = plot.channel_run(run, channel)
                 # FFT analysis
-                fft_file = os.path.join(run.plot_dir, f'fft{i}.png')
-                rfftfreq, rfft = fft(run, channel, plot_frequencies, log)
-                plot.fft(rfftfreq, rfft, run, channel, plot_frequencies, 
-                        logfreq=False, plot_file=fft_file)
+                rfftfreq, rfft = get_fft(run, channel, plot_frequencies)
+                tasks.append((os.path.join(run.plot_dir, f'fft{i}.png'), 
+                        plot.fft, (rfftfreq, rfft, ch_run, channel, 
+                        plot_frequencies), {'logfreq': False}))
                 # Colormap
-                cmap_file = os.path.join(run.plot_dir, f'colormap{i}.png')
-                plot.save_colormaps(run, channel, cmap_file)
+                tasks.append((os.path.join(run.plot_dir, f'colormap{i}.png'),
+                        plot.save_colormaps, (ch_run, channel), {}))
                 # Frequency slices
-                fslice_file = os.path.join(run.plot_dir, f'fslice{i}.png')
-                plot.save_freq_slices([run], channel, plot_frequencies, 
-                        impacts=impacts, plot_file=fslice_file)
+                tasks.append((os.path.join(run.plot_dir, f'fslice{i}.png'),
+                        plot.save_freq_slices, ([ch_run], channel, 
+                        plot_frequencies), {'impacts': impacts}))
                 # Time slices
-                tslice_file = os.path.join(run.plot_dir, f'tslice{i}.png')
-                plot.save_time_slices(run, channel, slice_times, tslice_file)
-                # Update progress
-                p.update(i)
+                tasks.append((os.path.join(run.plot_dir, f'tslice{i}.png'),
+                        plot.save_time_slices, (ch_run, channel, slice_times),
+                        {}))
+            # Render this run's plots before moving on to the next run
+            profiler.reset()
+            plot.render(tasks, jobs=args.jobs, message='\nPlotting...')
+            if args.profile:
+                profiler.save(run.psd_profile, f'{run.name} plots', 
+                        append=True)
+        log.close()
         
     # Plot run comparisons
     if args.compare:
-        p = utils.Progress(runs[0].channels, '\nPlotting run comparisons...')
+        tasks = []
         multirun_dir = os.path.join('out', 'multirun')
         if not os.path.exists(multirun_dir): os.makedirs(multirun_dir)
+        fft_freqs = np.array([1e-3, 5e-3, 3e-2])
+        fft_freqs = get_exact_freq(runs[0].psd_cube.summarized_freqs(), 
+                fft_freqs)
         for i, channel in enumerate(runs[0].channels):
-            plot.compare_colormaps(runs, channel, 
-                    plot_file=os.path.join(multirun_dir, f'colormap{i}.png'))
-            plot.save_freq_slices(runs, channel, plot_frequencies, 
-                    impacts=impacts, 
-                    plot_file=os.path.join(multirun_dir, f'fslice{i}.png'))
-            fft_freqs = np.array([1e-3, 5e-3, 3e-2])
-            fft_freqs = get_exact_freq(runs[0].psd_summary, fft_freqs)
-            plot.compare_fft(runs, channel, fft_freqs, 
-                    plot_file=os.path.join(multirun_dir, f'fft{i}.png'))
-            p.update(i)
+            ch_runs = [plot.channel_run(run, channel) for run in runs]
+            tasks.append((os.path.join(multirun_dir, f'colormap{i}.png'),
+                    plot.compare_colormaps, (ch_runs, channel), {}))
+            tasks.append((os.path.join(multirun_dir, f'fslice{i}.png'),
+                    plot.save_freq_slices, (ch_runs, channel, 
+                    plot_frequencies), {'impacts': impacts}))
+            tasks.append((os.path.join(multirun_dir, f'fft{i}.png'),
+                    plot.compare_fft, (ch_runs, channel, fft_freqs), {}))
+        profiler.reset()
+        plot.render(tasks, jobs=args.jobs, message='\nPlotting...')
+        if args.profile:
+            for run in runs:
+                profiler.save(run.psd_profile, 'Run comparison plots', 
+                        append=True)
     
     print('Done!')
 
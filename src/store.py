@@ -0,0 +1,395 @@
+import os
+from glob import glob
+
+import numpy as np
+import pandas as pd
+
+from cube import PsdCube, stats, deviations, get_baseline, get_deviations, \
+        content_hash
+
+def save_array(file, arr):
+    '''
+    Saves a numpy array to a .npy file, writing to a temporary file first so
+    that an interrupted write never leaves a partial file behind.
+    '''
+    with open(file + '.tmp', 'wb') as f:
+        np.save(f, arr)
+    os.replace(file + '.tmp', file)
+
+def channel_file(store_dir, ch_idx):
+    return os.path.join(store_dir, f'channel{ch_idx}.npy')
+
+def deviation_file(store_dir, ch_idx):
+    return os.path.join(store_dir, f'deviation{ch_idx}.npy')
+
+def save_deviations(run, times, chunk_size=256):
+    '''
+    Saves the baseline PSD (the median over time of the median PSD) of each
+    channel in the run's summary store to baseline.npy, with index order
+    [channel, frequency], and the absolute and fractional deviations from
+    it to one array file per channel, with index order [time, deviation,
+    frequency]. The content hash of each channel's median PSD (see
+    median_hash()) is saved to hashes.npy while it is in memory. Only one
+    channel's median PSD is read into memory at once.
+
+    Input
+    -----
+      run : Run object
+      times : array of the store's GPS times
+      chunk_size : int, number of times to compute at once
+    '''
+    freqs = np.load(os.path.join(run.psd_store, 'freqs.npy'))
+    baselines = []
+    hashes = []
+    for ch_idx in range(len(run.channels)):
+        arr = np.load(channel_file(run.psd_store, ch_idx), mmap_mode='r')
+        # Median PSD with index order [time, frequency]
+        median = np.asarray(arr[:,list(stats).index('MEDIAN')])
+        baseline = get_baseline(median)
+        dev = np.lib.format.open_memmap(
+                deviation_file(run.psd_store, ch_idx) + '.tmp', mode='w+',
+                dtype='float64', 
+                shape=(median.shape[0], len(deviations), median.shape[1]))
+        for i in range(0, median.shape[0], chunk_size):
+            dev[i:i+chunk_size] = get_deviations(
+                    median[i:i+chunk_size], baseline).transpose(1, 0, 2)
+        dev.flush()
+        del dev
+        os.replace(deviation_file(run.psd_store, ch_idx) + '.tmp',
+                deviation_file(run.psd_store, ch_idx))
+        baselines.append(baseline)
+        hashes.append(content_hash(times, freqs, median))
+    save_array(os.path.join(run.psd_store, 'baseline.npy'), np.stack(baselines))
+    save_array(os.path.join(run.psd_store, 'hashes.npy'), np.array(hashes))
+
+def save_psd(run, summary):
+    '''
+    Saves a PSD summary to the run's columnar summary store. Each
+    channel is saved to its own array file with index order
+    [time, statistic, frequency], so that any channel, time range or
+    frequency range can be loaded without reading the rest of the run.
+    Frequencies not summarized at a given time are filled with NaN.
+
+    Input
+    -----
+      run : Run object
+      summary : PsdCube or DataFrame, output of psd.save_summary()
+    '''
+    if isinstance(summary, pd.DataFrame):
+        summary = PsdCube.from_frame(summary)
+    if not os.path.exists(run.psd_store): os.makedirs(run.psd_store)
+    for ch_idx, channel in enumerate(run.channels):
+        # Reorder to [time, statistic, frequency]
+        arr = summary.data[:,summary.channel_idx[channel]].transpose(1, 0, 2)
+        save_array(channel_file(run.psd_store, ch_idx),
+                np.ascontiguousarray(arr))
+    save_array(os.path.join(run.psd_store, 'freqs.npy'), summary.freqs)
+    save_array(os.path.join(run.psd_store, 'missing.npy'),
+            np.isin(summary.times, run.missing_times))
+    save_deviations(run, summary.times)
+    # Write times last: the store is only complete once this file exists
+    save_array(os.path.join(run.psd_store, 'times.npy'), summary.times)
+
+class PsdWriter:
+    '''
+    Writes a PSD summary to the run's summary store one time at a time, so
+    that the whole summary never has to be held in memory. The time and
+    frequency axes are fixed in advance, and times which are never written
+    (such as time gaps) are left as NaN and marked as missing. The existing
+    store is only replaced once close() is called.
+    '''
+    def __init__(self, run, times, freqs, chunk_size=256):
+        '''
+        Input
+        -----
+          run : Run object
+          times : sorted array of all GPS times, including time gaps
+          freqs : sorted array of frequencies
+          chunk_size : int, number of times to initialize at once
+        '''
+        self.run = run
+        self.times = np.asarray(times)
+        self.freqs = np.asarray(freqs)
+        self.time_idx = {t: i for i, t in enumerate(self.times)}
+        self.written = np.zeros(len(self.times), dtype=bool)
+        if not os.path.exists(run.psd_store): os.makedirs(run.psd_store)
+        # One array per channel with index order [time, statistic, frequency]
+        self.arrays = []
+        for ch_idx in range(len(run.channels)):
+            arr = np.lib.format.open_memmap(
+                    channel_file(run.psd_store, ch_idx) + '.tmp', mode='w+',
+                    dtype='float64', 
+                    shape=(len(self.times), len(stats), len(self.freqs)))
+            for i in range(0, len(self.times), chunk_size):
+                arr[i:i+chunk_size] = np.nan
+            self.arrays.append(arr)
+
+    def write(self, time, freqs, summary):
+        '''
+        Writes the summary of one time. Frequencies not on the store's
+        frequency axis are skipped with a warning.
+
+        Input
+        -----
+          time : int, GPS time
+          freqs : sorted array of frequencies
+          summary : 3D array with index order [channel, statistic, frequency],
+                    channels in run.channels order
+        '''
+        t = self.time_idx[time]
+        self.written[t] = True
+        if np.array_equal(freqs, self.freqs):
+            for ch_idx, arr in enumerate(self.arrays):
+                arr[t] = summary[ch_idx]
+            return
+        f = np.minimum(np.searchsorted(self.freqs, freqs), len(self.freqs) - 1)
+        known = self.freqs[f] == freqs
+        if not known.all():
+            print(f'Warning: skipping {np.sum(~known)} unexpected frequencies '
+                    f'at time {time}')
+        for ch_idx, arr in enumerate(self.arrays):
+            arr[t][:,f[known]] = summary[ch_idx][:,known]
+
+    def close(self):
+        ''' Replaces the run's summary store with the written arrays '''
+        for arr in self.arrays: arr.flush()
+        self.arrays = []
+        # Remove times first: the store is incomplete until it is rewritten
+        times_file = os.path.join(self.run.psd_store, 'times.npy')
+        if os.path.exists(times_file): os.remove(times_file)
+        for ch_idx in range(len(self.run.channels)):
+            file = channel_file(self.run.psd_store, ch_idx)
+            os.replace(file + '.tmp', file)
+        save_array(os.path.join(self.run.psd_store, 'freqs.npy'), self.freqs)
+        save_array(os.path.join(self.run.psd_store, 'missing.npy'),
+                ~self.written)
+        save_deviations(self.run, self.times)
+        save_array(times_file, self.times)
+
+def open_psd(run):
+    '''
+    Returns a tuple of the time array, frequency array and list of
+    memory-mapped channel arrays with index order [time, statistic,
+    frequency] of the run's summary store, in run.channels order. Summaries
+    saved as psd.pkl by older versions are first converted to the store.
+    '''
+    times_file = os.path.join(run.psd_store, 'times.npy')
+    if not os.path.exists(times_file): save_psd(run, load_cube(run))
+    arrays = [np.load(channel_file(run.psd_store, ch_idx), mmap_mode='r')
+            for ch_idx in range(len(run.channels))]
+    return (np.load(times_file), np.load(os.path.join(run.psd_store,
+            'freqs.npy')), arrays)
+
+class StoreCube(PsdCube):
+    '''
+    A PsdCube backed by the run's memory-mapped summary store rather than a
+    dense array, so that opening it reads only the time and frequency axes.
+    Statistics and deviations of a channel are read from disk when they are
+    used, and select() loads one channel into memory.
+    '''
+    def __init__(self, run):
+        times, freqs, arrays = open_psd(run)
+        missing = np.load(os.path.join(run.psd_store, 'missing.npy'))
+        super().__init__(None, run.channels, times, freqs, missing)
+        self.run = run
+        self.arrays = arrays
+
+    def get(self, stat, channel, time=None, freq=None):
+        arr = self.arrays[self.channel_idx[channel]][:,self.stat_idx[stat]]
+        if time is not None: arr = arr[self.time_idx[time]]
+        if freq is not None: arr = arr[..., self.freq_idx[freq]]
+        return arr
+
+    def select(self, channel):
+        ''' Returns a PsdCube of one channel, loaded into memory '''
+        return load_cube(self.run, channel)
+
+    def get_baseline(self, channel):
+        if self.baseline is None:
+            self.baseline = np.load(os.path.join(self.run.psd_store, 
+                    'baseline.npy'))
+        return self.baseline[self.channel_idx[channel]]
+
+    def get_deviation(self, deviation, channel):
+        arr = np.load(deviation_file(self.run.psd_store, 
+                self.channel_idx[channel]), mmap_mode='r')
+        return arr[:,list(deviations).index(deviation)]
+
+    def to_frame(self):
+        '''
+        Returns the summary DataFrame, converting one channel at a time.
+        Unlike PsdCube.to_frame(), frequencies kept in time gaps are those
+        summarized in the same channel.
+        '''
+        return pd.concat([self.select(channel).to_frame()
+                for channel in sorted(self.channels)])
+
+def open_cube(run):
+    '''
+    Returns a StoreCube of the run's summary store, converting a psd.pkl
+    summary of an older version first if needed.
+    '''
+    return StoreCube(run)
+
+def open_median(run, channel, time_range=None):
+    '''
+    Returns a tuple of the time array, frequency array and memory-mapped
+    median PSD of one channel, index order [time, frequency], from the
+    run's summary store.
+
+    Input
+    -----
+      run : Run object
+      channel : string, channel name
+      time_range : tuple of inclusive GPS time bounds; either can be None
+    '''
+    times, freqs, arrays = open_psd(run)
+    t_slice = get_slice(times, time_range)
+    median = arrays[run.get_channel_index(channel)][t_slice,
+            list(stats).index('MEDIAN')]
+    return times[t_slice], freqs, median
+
+def median_hash(run, channel, time_range=None):
+    '''
+    Returns the content hash of one channel's median PSD in the run's
+    summary store (see cube.content_hash()), the key of its FFT. Takes the
+    same arguments as open_median(). The hash of all times is read from
+    hashes.npy, saved with the store; others are computed from the median.
+    '''
+    hashes_file = os.path.join(run.psd_store, 'hashes.npy')
+    # Hashes are only current if the store is complete
+    complete = os.path.exists(os.path.join(run.psd_store, 'times.npy'))
+    if time_range is None and complete and os.path.exists(hashes_file):
+        return str(np.load(hashes_file)[run.get_channel_index(channel)])
+    return content_hash(*open_median(run, channel, time_range))
+
+def psd_exists(run):
+    ''' Returns whether a PSD summary store or summary file exists '''
+    return os.path.exists(os.path.join(run.psd_store, 'times.npy')) \
+        or os.path.exists(run.psd_file)
+
+def get_slice(axis, bounds):
+    ''' Returns the slice of a sorted axis array within inclusive bounds '''
+    if bounds is None: return slice(None)
+    lo, hi = bounds
+    start = 0 if lo is None else np.searchsorted(axis, lo, side='left')
+    stop = len(axis) if hi is None else np.searchsorted(axis, hi, side='right')
+    return slice(start, stop)
+
+def load_cube(run, channel=None, freq_range=None, time_range=None):
+    '''
+    Returns a PsdCube of the run's PSD summaries. Only the requested
+    channels, times and frequencies are read from the memory-mapped summary
+    store. Falls back to the psd.pkl summary file of older runs.
+
+    Input
+    -----
+      run : Run object
+      channel : string or list of strings, channel name(s) (default: all)
+      freq_range : tuple of inclusive frequency bounds; either can be None
+      time_range : tuple of inclusive GPS time bounds; either can be None
+    '''
+    if channel is None: channel = run.channels
+    channels = [c for c in run.channels if c in np.atleast_1d(channel)]
+    times_file = os.path.join(run.psd_store, 'times.npy')
+    if not os.path.exists(times_file):
+        return PsdCube.from_frame(
+                load_pickle(run, channels, freq_range, time_range))
+
+    times = np.load(times_file)
+    freqs = np.load(os.path.join(run.psd_store, 'freqs.npy'))
+    missing = np.load(os.path.join(run.psd_store, 'missing.npy'))
+    t_slice = get_slice(times, time_range)
+    f_slice = get_slice(freqs, freq_range)
+    times, freqs, missing = times[t_slice], freqs[f_slice], missing[t_slice]
+
+    data = np.empty((len(stats), len(channels), len(times), len(freqs)))
+    for i, ch in enumerate(channels):
+        arr = np.load(channel_file(run.psd_store, run.get_channel_index(ch)),
+                mmap_mode='r')
+        data[:,i] = arr[t_slice,:,f_slice].transpose(1, 0, 2)
+    # Stored baselines are over the whole run, so only use them if all times
+    # are loaded
+    baseline, deviation = None, None
+    baseline_file = os.path.join(run.psd_store, 'baseline.npy')
+    if time_range is None and os.path.exists(baseline_file):
+        ch_indices = [run.get_channel_index(ch) for ch in channels]
+        baseline = np.load(baseline_file)[ch_indices][:,f_slice]
+        deviation = np.empty((len(deviations),) + data.shape[1:])
+        for i, ch_idx in enumerate(ch_indices):
+            arr = np.load(deviation_file(run.psd_store, ch_idx), mmap_mode='r')
+            deviation[:,i] = arr[:,:,f_slice].transpose(1, 0, 2)
+    return PsdCube(data, channels, times, freqs, missing, baseline, deviation)
+
+def load_psd(run, channel=None, freq_range=None, time_range=None):
+    '''
+    Returns the PSD summary DataFrame for a run, MultiIndexed by channel,
+    time and frequency. Takes the same arguments as load_cube().
+    '''
+    if not os.path.exists(os.path.join(run.psd_store, 'times.npy')):
+        if channel is None: channel = run.channels
+        return load_pickle(run, np.atleast_1d(channel), freq_range, time_range)
+    return load_cube(run, channel, freq_range, time_range).to_frame()
+
+def load_pickle(run, channels, freq_range=None, time_range=None):
+    ''' Selects from a whole-run psd.pkl summary file, as in load_psd() '''
+    summary = pd.read_pickle(run.psd_file)
+    summary = summary[summary.index.get_level_values('CHANNEL').isin(channels)]
+    for level, bounds in [('FREQ', freq_range), ('TIME', time_range)]:
+        if bounds is not None:
+            values = summary.index.get_level_values(level)
+            lo, hi = bounds
+            if lo is not None: summary = summary[values >= lo]
+            values = summary.index.get_level_values(level)
+            if hi is not None: summary = summary[values <= hi]
+    return summary
+
+def fft_files(run, key):
+    ''' Returns the FFT and FFT frequency array files for a content hash '''
+    return (os.path.join(run.fft_store, f'{key}.npy'),
+            os.path.join(run.fft_store, f'{key}_freqs.npy'))
+
+def save_fft(run, key, rfftfreq, rfft_chunks, n_freqs):
+    '''
+    Saves the FFT over time of every frequency bin of one channel to the
+    run's FFT store, one chunk of frequencies at a time, so the whole array
+    never has to be held in memory. Saved with index order
+    [frequency, FFT frequency].
+
+    Input
+    -----
+      run : Run object
+      key : string, content hash of the channel summary (see 
+            median_hash())
+      rfftfreq : 1D array of FFT frequencies
+      rfft_chunks : iterable of 2D FFT arrays, in frequency order
+      n_freqs : int, total number of frequency bins
+    '''
+    if not os.path.exists(run.fft_store): os.makedirs(run.fft_store)
+    fft_file, freqs_file = fft_files(run, key)
+    arr = np.lib.format.open_memmap(fft_file + '.tmp', mode='w+', 
+            dtype='float64', shape=(n_freqs, len(rfftfreq)))
+    start = 0
+    for chunk in rfft_chunks:
+        arr[start:start+len(chunk)] = chunk
+        start += len(chunk)
+    arr.flush()
+    del arr
+    save_array(freqs_file, rfftfreq)
+    # Write FFT array last: the entry is only complete once this file exists
+    os.replace(fft_file + '.tmp', fft_file)
+
+def load_fft(run, key):
+    '''
+    Returns a tuple of the FFT frequency array and the memory-mapped FFT
+    array saved under a content hash, or None if there isn't one.
+    '''
+    fft_file, freqs_file = fft_files(run, key)
+    if not os.path.exists(fft_file): return None
+    return np.load(freqs_file), np.load(fft_file, mmap_mode='r')
+
+def prune_fft(run, keys):
+    ''' Deletes FFT arrays in the run's FFT store not saved under keys '''
+    keep = set(f for key in keys for f in fft_files(run, key))
+    for f in glob(os.path.join(run.fft_store, '*.npy*')):
+        if f not in keep: os.remove(f)
@@ -1,9 +1,15 @@
 import sys
 from glob import glob
 import os
+import multiprocessing
+import threading
+import atexit
+import pickle
 
 import numpy as np
-from astropy.time import Time
+import pandas as pd
+
+import profiler
 
 class Progress:
     ''' A loop progress indicator class '''
@@ -27,24 +33,131 @@ class Progress:
         sys.stdout.write('\n')
         sys.stdout.flush()
 
+# Log levels
+DEBUG = 10
+INFO = 20
+
 class Log:
-    ''' A class for outputting to a log file '''
-    def __init__(self, log_file=None, header='Log'):
+    '''
+    A class for outputting to a log file. In buffered mode, messages are
+    collected in memory and written by a background thread whenever the
+    buffer grows past flush_size characters or every flush_interval seconds,
+    instead of reopening the file for every message. Messages below the log
+    level are skipped; a message can also be a function returning the
+    message, so that expensive messages are only built if they are logged.
+    '''
+    def __init__(self, log_file=None, header='Log', capture=False, level=INFO,
+            buffered=False, flush_size=2**16, flush_interval=1.):
         self.log_file = log_file
+        self.level = level
+        # Keep messages in memory instead, e.g. to pass from worker processes
+        self.messages = [] if capture else None
         if log_file:
             print(f'Logging output to {log_file}')
+            log_dir = os.path.dirname(log_file)
+            if log_dir and not os.path.exists(log_dir): 
+                os.makedirs(log_dir, exist_ok=True)
             with open(log_file, 'w+') as f:
                 f.write(header)
                 f.write('\n\n')
+        # Set up buffer and background writer
+        self.buffered = buffered and bool(log_file) and not capture
+        if self.buffered:
+            self.buffer = []
+            self.buffer_size = 0
+            self.flush_size = flush_size
+            self.flush_interval = flush_interval
+            self.buffer_lock = threading.Lock()
+            self.write_lock = threading.Lock()
+            self.flush_event = threading.Event()
+            self.closed = False
+            self.file = open(log_file, 'a+')
+            self.writer = threading.Thread(target=self.write_loop, daemon=True)
+            self.writer.start()
+            # Make sure buffered messages are written on exit
+            atexit.register(self.close)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
     
-    def log(self, message=''):
-        if self.log_file:
+    def enabled(self, level):
+        ''' Returns whether messages of the given level are logged '''
+        return level >= self.level
+    
+    def log(self, message='', level=INFO):
+        if not self.enabled(level): return
+        if callable(message): message = message()
+        if self.messages is not None:
+            self.messages.append(message)
+        elif self.buffered:
+            with self.buffer_lock:
+                self.buffer.append(message + '\n')
+                self.buffer_size += len(message) + 1
+                full = self.buffer_size >= self.flush_size
+            if full: self.flush_event.set()
+        elif self.log_file:
             with open(self.log_file, 'a+') as f:
                 f.write(message)
                 f.write('\n')
+    
+    def debug(self, message=''):
+        self.log(message, level=DEBUG)
+    
+    def write_loop(self):
+        # Background writer; flushes when woken or after flush_interval
+        while not self.closed:
+            self.flush_event.wait(self.flush_interval)
+            self.flush_event.clear()
+            self.flush()
+    
+    def flush(self):
+        ''' Writes all buffered messages to the log file '''
+        if not self.buffered: return
+        # Hold the write lock while swapping buffers so messages stay in order
+        with self.write_lock:
+            with self.buffer_lock:
+                messages = self.buffer
+                self.buffer = []
+                self.buffer_size = 0
+            if messages and not self.file.closed:
+                self.file.write(''.join(messages))
+                self.file.flush()
+    
+    def close(self):
+        ''' Writes any remaining messages and stops the background writer '''
+        if not self.buffered or self.closed: return
+        self.closed = True
+        self.flush_event.set()
+        self.writer.join()
+        self.flush()
+        self.file.close()
+        atexit.unregister(self.close)
+
+class lazy:
+    '''
+    Decorator for an attribute which is calculated the first time it is
+    accessed, then stored on the object like any other attribute.
+    '''
+    def __init__(self, func):
+        self.func = func
+        self.__doc__ = func.__doc__
+
+    def __get__(self, obj, cls):
+        if obj is None: return self
+        value = self.func(obj)
+        setattr(obj, self.func.__name__, value)
+        return value
 
 class Run:
-    ''' A class to store information about a given run '''
+    '''
+    A class to store information about a given run. Time directories, GPS
+    times and the attributes derived from them are only calculated when
+    first needed, and are saved to a run index which is reused for as long
+    as the run directory's listing doesn't change.
+    '''
     channels = np.array(['x', 'y', 'z', 'θ', 'η', 'ϕ'])
     
     def __init__(self, path, name=None):
@@ -56,40 +169,112 @@ class Run:
             self.mode = split_path[1]
             self.name = split_path[2]
             
-            # Output directories
+            # Output directories, created when first written to
             self.output_dir = os.path.join('out', self.mode, self.name)
             self.summary_dir = os.path.join(self.output_dir, 'summaries')
-            if not os.path.exists(self.summary_dir): 
-                os.makedirs(self.summary_dir)
             self.plot_dir = os.path.join(self.output_dir, 'plots')
-            if not os.path.exists(self.plot_dir): 
-                os.makedirs(self.plot_dir)
+            # Binary chain cache made by psd.py --pack-chains
+            self.chain_dir = os.path.join(self.output_dir, 'chains')
             
             # Summary file paths
             self.psd_file = os.path.join(self.summary_dir, 'psd.pkl')
+            self.psd_store = os.path.join(self.summary_dir, 'psd')
             self.psd_log = os.path.join(self.summary_dir, 'psd.log')
             self.fft_log = os.path.join(self.summary_dir, 'fft.log')
+            self.fft_store = os.path.join(self.summary_dir, 'fft')
+            self.psd_profile = os.path.join(self.summary_dir, 'psd_profile.txt')
             self.linecounts_file = os.path.join(self.summary_dir, 'linecounts.pkl')
             self.linechain_file = os.path.join(self.summary_dir, 'linechain.pkl')
-            
-            # Get time directories which contain the data
-            self.time_dirs = sorted(glob(os.path.join(path, '*'+os.sep)))
-            # Various time formats
-            self.gps_times = np.array(
-                sorted([self.get_time(d) for d in self.time_dirs])
-            )
-            self.days_elapsed = self.gps2day(self.gps_times)
-            self.iso_dates = self.gps2iso(self.gps_times)
-            # Median time step in seconds
-            self.dt = np.median(np.diff(self.gps_times))
-            # List of GPS times missing from the run
-            self.missing_times = self.get_missing_times()
-            # Run start ISO date
-            self.start_date = self.iso_dates[0]
+            self.linechain_profile = os.path.join(self.summary_dir, 
+                    'linechain_profile.txt')
+            # Manifests of the time directories included in each summary
+            self.psd_manifest = os.path.join(self.summary_dir, 
+                    'psd_manifest.pkl')
+            self.linechain_manifest = os.path.join(self.summary_dir, 
+                    'linechain_manifest.pkl')
+            self.index_file = os.path.join(self.summary_dir, 'run_index.pkl')
+            # Results saved while summarizing, and inputs which failed
+            self.psd_checkpoint = os.path.join(self.summary_dir, 
+                    'checkpoint', 'psd')
+            self.linechain_checkpoint = os.path.join(self.summary_dir, 
+                    'checkpoint', 'linechain')
+            self.psd_quarantine = os.path.join(self.summary_dir, 
+                    'psd_quarantine.txt')
+            self.linechain_quarantine = os.path.join(self.summary_dir, 
+                    'linechain_quarantine.txt')
             
         else:
             raise FileNotFoundError(f'{path} does not exist')
     
+    @lazy
+    def index(self):
+        '''
+        Run index: a dict of the time directories which contain the data,
+        their GPS times, the median time step and the GPS times missing
+        from the run. Loaded from the index file if the run directory hasn't
+        changed since it was saved.
+        '''
+        mtime = os.stat(self.path).st_mtime_ns
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file, 'rb') as f:
+                    index = pickle.load(f)
+                if index['path'] == self.path and index['mtime'] == mtime:
+                    return index
+            except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+                pass
+        # Get time directories which contain the data
+        time_dirs = sorted(glob(os.path.join(self.path, '*'+os.sep)))
+        gps_times = np.array(sorted([self.get_time(d) for d in time_dirs]))
+        # Median time step in seconds
+        dt = np.median(np.diff(gps_times))
+        index = {
+            'path': self.path, 'mtime': mtime, 
+            'time_dirs': time_dirs, 'gps_times': gps_times, 'dt': dt,
+            'missing_times': self.get_missing_times(gps_times, dt)
+        }
+        # Save index; write to a temporary file first in case of other runs
+        if not os.path.exists(self.summary_dir): 
+            os.makedirs(self.summary_dir, exist_ok=True)
+        tmp_file = f'{self.index_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(index, f)
+        os.replace(tmp_file, self.index_file)
+        return index
+    
+    @lazy
+    def time_dirs(self):
+        ''' Sorted list of time directories which contain the data '''
+        return self.index['time_dirs']
+    
+    @lazy
+    def gps_times(self):
+        ''' Sorted array of GPS times '''
+        return self.index['gps_times']
+    
+    @lazy
+    def dt(self):
+        ''' Median time step in seconds '''
+        return self.index['dt']
+    
+    @lazy
+    def missing_times(self):
+        ''' List of GPS times missing from the run '''
+        return self.index['missing_times']
+    
+    @lazy
+    def days_elapsed(self):
+        return self.gps2day(self.gps_times)
+    
+    @lazy
+    def iso_dates(self):
+        return self.gps2iso(self.gps_times)
+    
+    @lazy
+    def start_date(self):
+        ''' Run start ISO date '''
+        return self.gps2iso(self.gps_times[0])
+    
     def get_time(self, time_dir):
         return int(time_dir[-11:-1])
         
@@ -102,6 +287,8 @@ class Run:
     
     def gps2iso(self, gps_time):
         ''' Convert GPS time to ISO date '''
+        # astropy is slow to import, so only load it when dates are needed
+        from astropy.time import Time
         gps_time = Time(gps_time, format='gps')
         return Time(gps_time, format='iso')
     
@@ -115,21 +302,125 @@ class Run:
         return self.gps_times[time_index]
     
     def get_missing_times(self, gps_times=None, dt=None):
-        missing_times = []
-        if not gps_times: gps_times = self.gps_times
-        if not dt: dt = int(self.dt)
-        for i in range(len(gps_times) - 1):
-            diff = gps_times[i+1] - gps_times[i]
-            if diff > dt + 1:
-                # Number of new times to insert
-                n = int(np.ceil(diff / dt)-1)
-                # List of missing times, with same time interval
-                missing_times += [gps_times[i] + dt * k for k in range(1, n+1)]
-        return missing_times
+        if gps_times is None: gps_times = self.gps_times
+        if not dt: dt = self.dt
+        dt = int(dt)
+        gps_times = np.asarray(gps_times)
+        diffs = np.diff(gps_times)
+        gaps = np.flatnonzero(diffs > dt + 1)
+        # Number of new times to insert in each gap
+        n = np.ceil(diffs[gaps] / dt).astype(int) - 1
+        # Missing times, with same time interval, counting from each gap start
+        k = np.arange(np.sum(n)) - np.repeat(np.cumsum(n) - n, n) + 1
+        return list(np.repeat(gps_times[gaps], n) + dt * k)
     
     def get_channel_index(self, channel):
         return self.channels.tolist().index(channel)
+    
+    def scan_time_dirs(self, pattern='*'):
+        '''
+        Returns a manifest DataFrame indexed by time directory path, with the
+        latest modification time and total size of the matching files in 
+        each time directory.
+        
+        Input
+        -----
+          pattern : glob pattern of the input files to include
+        '''
+        manifest = []
+        for time_dir in self.time_dirs:
+            stats = [os.stat(f) for f in glob(os.path.join(time_dir, pattern))]
+            manifest.append((
+                max([st.st_mtime for st in stats], default=0),
+                sum([st.st_size for st in stats])
+            ))
+        return pd.DataFrame(manifest, columns=['MTIME', 'SIZE'],
+                index=pd.Index(self.time_dirs, name='PATH'))
+
 
+def get_changed_dirs(manifest, old_manifest):
+    '''
+    Returns a list of time directories which are new or modified in the 
+    manifest compared to the old manifest.
+    
+    Input
+    -----
+      manifest : DataFrame, output of Run.scan_time_dirs()
+      old_manifest : DataFrame, previously saved manifest
+    '''
+    old_manifest = old_manifest.reindex(manifest.index)
+    changed = (manifest != old_manifest).any(axis=1)
+    return list(manifest.index[changed])
+
+
+def imap(func, iterable, jobs=1, message=''):
+    '''
+    Applies a function to each item of an iterable, yielding the results in
+    the original order and updating a progress indicator as they come in.
+    If jobs > 1, the items are distributed across a pool of worker processes,
+    so func and the items must be picklable.
+
+    Input
+    -----
+      func : function to apply to each item
+      iterable : items to process
+      jobs : int, number of worker processes (default: 1, run serially)
+      message : string, progress indicator status message
+    '''
+    items = list(iterable)
+    p = Progress(items, message)
+    if jobs > 1:
+        # Bring back the profiled stages of each item from the workers
+        profile = profiler.enabled
+        if profile: func = profiler.Collect(func)
+        with multiprocessing.Pool(jobs) as pool:
+            for i, result in enumerate(pool.imap(func, items)):
+                if profile: result = profiler.merge(*result)
+                p.update(i)
+                yield result
+    else:
+        for i, item in enumerate(items):
+            result = func(item)
+            p.update(i)
+            yield result
+
+def hpd(samples, alphas=(0.5, 0.1)):
+    '''
+    Returns the median and highest posterior density (HPD) credible intervals
+    of an array of samples, where each alpha is the desired probability of
+    type I error (so, 1 - C.I.). Equivalent to pymc3.stats.hpd, but the 
+    samples are sorted only once and every interval is computed from that
+    sort in a single vectorized pass over all columns.
+    
+    Input
+    -----
+      samples : numpy array, with samples along the first axis
+      alphas : list of floats, probabilities of type I error
+    
+    Output
+    ------
+      median : array with shape samples.shape[1:]
+      intervals : array with shape (len(alphas),) + samples.shape[1:] + (2,),
+                  where the last axis holds the lower and upper bounds
+    '''
+    with profiler.stage('hpd sort'):
+        sorted_samples = np.sort(samples, axis=0)
+    with profiler.stage('hpd intervals'):
+        n = sorted_samples.shape[0]
+        # Median is the mean of the middle one or two samples
+        median = (sorted_samples[(n-1)//2] + sorted_samples[n//2]) / 2
+        intervals = np.empty((len(alphas),) + sorted_samples.shape[1:] + (2,))
+        for i, alpha in enumerate(alphas):
+            # Number of samples spanned by each candidate interval
+            k = int(np.floor((1 - alpha) * n))
+            # Narrowest interval containing k samples
+            widths = sorted_samples[k:] - sorted_samples[:n-k]
+            lo = np.argmin(widths, axis=0)[np.newaxis]
+            intervals[i,...,0] = np.take_along_axis(
+                    sorted_samples, lo, axis=0)[0]
+            intervals[i,...,1] = np.take_along_axis(
+                    sorted_samples, lo+k, axis=0)[0]
+    return median, intervals
 
 def init_runs(paths):
     '''
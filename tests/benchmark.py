@@ -0,0 +1,232 @@
+'''
+Times and memory-profiles the PSD and linechain pipelines on synthetic runs
+of increasing size (see synthetic.py). For each scale point, every stage is
+timed over several repeats, then run once more under tracemalloc to find
+its peak memory use. Results are written to a JSON file so that they can be
+compared between versions.
+
+The disk cache is disabled so every stage is actually computed. Synthetic
+runs are kept in the working directory and reused if it's given again.
+
+Usage: python tests/benchmark.py [-o results.json] [options]
+'''
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import resource
+import tracemalloc
+import subprocess
+import contextlib
+
+import numpy as np
+
+import synthetic
+
+# Modules under test are imported in main() after changing directory
+
+def measure(func, repeat=3):
+    '''
+    Returns a tuple of the result of func() and a dict of its minimum and
+    mean wall time, minimum CPU time and peak traced memory. Output printed
+    by func() is discarded.
+    '''
+    wall = []
+    cpu = []
+    for i in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            t0, c0 = time.perf_counter(), time.process_time()
+            result = func()
+            wall.append(time.perf_counter() - t0)
+            cpu.append(time.process_time() - c0)
+    # Separate run for memory, since tracing slows everything down
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        func()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, {
+        'wall_min': min(wall), 'wall_mean': float(np.mean(wall)),
+        'cpu_min': min(cpu), 'peak_mem_mb': peak / 2**20,
+    }
+
+def max_rss_mb():
+    ''' Returns the peak resident set size of this process in MB '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+def benchmark_run(run_path, repeat, jobs):
+    '''
+    Benchmarks every stage on one run. Returns a list of result dicts.
+    '''
+    import linechain as lc
+    import plot
+    import psd
+    import utils
+
+    results = []
+    def record(stage, func, n=repeat, errors=()):
+        '''
+        Times func() and adds its stats to the results. Errors appended to
+        errors while it runs mark the stage as failed.
+        '''
+        result, stats = measure(func, n)
+        stats['stage'] = stage
+        stats['max_rss_mb'] = max_rss_mb()
+        stats['ok'] = len(errors) == 0
+        if errors: stats['error'] = errors[-1].strip().splitlines()[-1]
+        results.append(stats)
+        print(f'  {stage:<24} {stats["wall_min"]:8.3f} s '
+                f'{stats["peak_mem_mb"]:8.1f} MB'
+                + ('' if stats['ok'] else '  FAILED'))
+        return result
+
+    run = utils.Run(run_path)
+    # Summaries
+    run.psd_cube = record('psd.save_summary',
+            lambda: psd.save_summary(run, jobs=jobs))
+    run.linecounts, run.lc_summary = record('linechain.save_summary',
+            lambda: lc.save_summary(run, jobs=jobs))
+
+    # FFT of every frequency of one channel, then peaks at a few frequencies
+    channel = run.channels[0]
+    rfftfreq, rfft = record('psd.fft',
+            lambda: psd.fft(run, channel))
+    freqs = run.psd_cube.freqs
+    columns = np.searchsorted(freqs, psd.get_exact_freq(
+            run.psd_cube.summarized_freqs(),
+            np.array([1e-3, 1e-2, 1e-1])))
+    # Peak finding needs more than 2 * bin_width FFT frequencies
+    if rfft.shape[1] > 2 * 10 + 1:
+        record('psd.fft_peaks', lambda: [psd.fft_peaks(rfftfreq[i], rfft[i])
+                for i in columns])
+    else:
+        print('  Too few times for psd.fft_peaks, skipping')
+
+    # Plots of one channel, through the same path as the main scripts
+    plot_dir = os.path.join('out', 'benchmark_plots')
+    ch_run = plot.channel_run(run, channel)
+    impacts = psd.get_impacts('impacts.dat')
+    slice_times = run.gps_times[np.linspace(0, len(run.gps_times) - 1,
+            6).astype(int)]
+    tasks = [
+        ('plot.fft', plot.fft, (rfftfreq[columns], rfft[columns], ch_run,
+                channel, freqs[columns]), {'logfreq': False}),
+        ('plot.save_colormaps', plot.save_colormaps, (ch_run, channel), {}),
+        ('plot.save_freq_slices', plot.save_freq_slices, ([ch_run], channel,
+                freqs[columns]), {'impacts': impacts}),
+        ('plot.save_time_slices', plot.save_time_slices, (ch_run, channel,
+                slice_times), {}),
+        ('plot.linecounts_cmap', plot.linecounts_cmap, (ch_run, channel), {}),
+        ('plot.linechain_scatter', plot.linechain_scatter, (ch_run, channel,
+                'FREQ'), {}),
+    ]
+    for stage, func, args, kwargs in tasks:
+        task = (os.path.join(plot_dir, f'{stage}.png'), func, args, kwargs)
+        # render_task() catches plot errors, so check for them while timing
+        errors = []
+        def render():
+            plot_file, error = plot.render_task(task)
+            if error: errors.append(error)
+        record(stage, render, errors=errors)
+        if errors: print(errors[-1])
+    return results
+
+def get_commit():
+    ''' Returns the current git commit of the repository, if any '''
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the PSD and linechain pipelines.'
+    )
+    parser.add_argument('-o', '--output', default='benchmark.json',
+        help='JSON results file (default: benchmark.json)')
+    parser.add_argument('-s', '--scales', type=int, nargs='*',
+        default=[20, 100, 400],
+        help='numbers of time steps to benchmark (default: 20 100 400)')
+    parser.add_argument('--chains', type=int, default=100,
+        help='number of psd.dat files per time directory (default: 100)')
+    parser.add_argument('--freqs', type=int, default=200,
+        help='approximate number of frequencies (default: 200)')
+    parser.add_argument('--samples', type=int, default=500,
+        help='number of samples in each linechain file (default: 500)')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+        help='number of timed repeats of each stage (default: 3)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help='number of parallel jobs for the summaries (default: 1)')
+    parser.add_argument('-w', '--workdir', default=None,
+        help='directory for synthetic runs, kept afterwards (default: a \
+              temporary directory)')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='lisa_benchmark_')
+    workdir = os.path.abspath(workdir)
+    # Make the modules under test importable after changing directory
+    src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            os.pardir, 'src')
+    sys.path.insert(0, os.path.abspath(src_dir))
+    import cache
+    cache.configure(use_cache=False)
+
+    import matplotlib
+    import pandas as pd
+    report = {
+        'meta': {
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': get_commit(),
+            'platform': platform.platform(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'matplotlib': matplotlib.__version__,
+            'cpus': os.cpu_count(),
+            'repeat': args.repeat,
+            'jobs': args.jobs,
+        },
+        'results': [],
+    }
+    start_dir = os.getcwd()
+    try:
+        for n_times in args.scales:
+            root = os.path.join(workdir, f'times{n_times}_chains{args.chains}'
+                    f'_freqs{args.freqs}_samples{args.samples}')
+            name = f'run_{n_times}'
+            run_path = os.path.join('data', 'drs', name) + os.sep
+            print(f'\n-- {n_times} time steps --')
+            if not os.path.exists(os.path.join(root, run_path)):
+                print('Generating synthetic run...')
+                synthetic.generate_run(root, name, n_times=n_times,
+                        gaps=[(n_times // 4, max(n_times // 20, 1))],
+                        n_chains=args.chains, n_freqs=args.freqs,
+                        n_samples=args.samples, impacts=5)
+            os.chdir(root)
+            scale = {'n_times': n_times, 'n_chains': args.chains,
+                    'n_freqs': args.freqs, 'n_samples': args.samples}
+            for stats in benchmark_run(run_path, args.repeat, args.jobs):
+                report['results'].append({**scale, **stats})
+            os.chdir(start_dir)
+    finally:
+        os.chdir(start_dir)
+        if args.workdir is None: shutil.rmtree(workdir)
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'\nResults written to {output}')
+    failed = sorted(set(r['stage'] for r in report['results'] if not r['ok']))
+    if failed:
+        print(f'Failed stages: {", ".join(failed)}')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+'''
+Compares utils.hpd against pymc3.stats.hpd on the chains of one time
+directory, checking that the results agree and timing both.
+
+Usage: PYTHONPATH=src python tests/hpd_benchmark.py <run dir> [time dir]
+'''
+
+import sys
+import timeit
+
+import numpy as np
+
+import psd
+import utils
+
+# Number of repeats for each timing
+repeat = 5
+
+run = utils.Run(sys.argv[1])
+time_dir = sys.argv[2] if len(sys.argv) > 2 else run.time_dirs[0]
+# Chain array with index order [chain, frequency, channel]
+freqs, chains = psd.load_chains(run, time_dir)
+chains = np.array(chains)
+print(f'{time_dir}: chain array shape {chains.shape}')
+
+def numpy_hpd():
+    return utils.hpd(chains, alphas=(0.5, 0.1))
+
+t_numpy = min(timeit.repeat(numpy_hpd, number=1, repeat=repeat))
+print(f'utils.hpd:       {t_numpy * 1000:.1f} ms')
+
+try:
+    from pymc3.stats import hpd
+except ImportError:
+    print('pymc3 not installed, skipping comparison')
+    sys.exit()
+
+def pymc3_hpd():
+    median = np.median(chains, axis=0)
+    return median, np.stack([hpd(chains, alpha=0.5), hpd(chains, alpha=0.1)])
+
+t_pymc3 = min(timeit.repeat(pymc3_hpd, number=1, repeat=repeat))
+print(f'pymc3.stats.hpd: {t_pymc3 * 1000:.1f} ms')
+print(f'Speedup: {t_pymc3 / t_numpy:.1f}x')
+
+# Check results agree
+for expected, actual in zip(pymc3_hpd(), numpy_hpd()):
+    np.testing.assert_allclose(actual, expected, rtol=1e-12)
+print('Results match.')
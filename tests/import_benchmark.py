@@ -0,0 +1,109 @@
+'''
+Checks the start-up cost of the analysis scripts. Each scenario runs in a
+fresh interpreter, as a spawned worker process would, and is timed from
+launch to exit. Fails if a scenario takes longer than its budget or loads
+a heavy dependency (matplotlib, astropy, scipy, pymc3, theano, sklearn)
+which it doesn't need.
+
+Usage: python tests/import_benchmark.py [run dir] [--budget SECONDS]
+
+The keep-all scenario runs psd.main() with --keep-all until it would
+render the first plot, on the given run directory (relative to the
+working directory, which should contain data/ and out/) or else on the
+runs in data/. The run should already be summarized, FFTs included, as
+psd.py --keep-all would otherwise generate them.
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+import numpy as np
+
+src_dir = os.path.abspath(os.path.join(os.path.dirname(__file__),
+        os.pardir, 'src'))
+heavy_modules = ['matplotlib', 'astropy', 'scipy', 'pymc3', 'theano',
+        'sklearn']
+
+# Code run by each scenario
+scenarios = {
+    # Modules imported by worker processes summarizing PSDs or linechains
+    'psd worker': 'import psd',
+    'linechain worker': 'import linechain',
+    # psd.py --keep-all up to the point where it renders the first plot;
+    # the plot module is replaced by a stub which stops it there
+    'psd keep-all': '''
+import types
+import psd
+class Stop(Exception): pass
+class Plot(types.ModuleType):
+    def __getattr__(self, name): return lambda *args, **kwargs: None
+    def render(self, *args, **kwargs): raise Stop
+sys.modules['plot'] = Plot('plot')
+sys.argv = ['psd.py', '--keep-all'] + ([run_path] if run_path else [])
+try: psd.main()
+except Stop: pass
+''',
+}
+
+def run_scenario(code, run_path=None):
+    '''
+    Runs code in a fresh interpreter. Returns the wall time from launch to
+    exit and the list of heavy modules it loaded.
+    '''
+    script = f'import sys, json\nrun_path = {run_path!r}\n{code}\n' \
+            f'print(json.dumps([m for m in {heavy_modules!r} ' \
+            'if m in sys.modules]))'
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+            [src_dir] + [p for p in [env.get('PYTHONPATH')] if p])
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', script], env=env,
+            check=True, stdout=subprocess.PIPE).stdout.decode()
+    wall = time.perf_counter() - start
+    return wall, json.loads(output.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check the start-up cost of the analysis scripts.'
+    )
+    parser.add_argument('run', nargs='?', default=None,
+        help='run directory for the keep-all scenario')
+    parser.add_argument('-b', '--budget', type=float, default=1.0,
+        help='maximum median start-up time of each scenario in seconds \
+              (default: 1.0)')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+        help='number of times to run each scenario (default: 5)')
+    parser.add_argument('-o', '--output', default=None,
+        help='JSON file to write the results to, if any')
+    args = parser.parse_args()
+
+    # Baseline cost of starting the interpreter and importing numpy
+    baseline = np.median([run_scenario('import numpy')[0]
+            for i in range(args.repeat)])
+    print(f'{"interpreter + numpy":<20} {baseline:6.3f} s')
+    results = {'interpreter + numpy': {'wall_median': baseline}}
+    failed = False
+    for name, code in scenarios.items():
+        runs = [run_scenario(code, args.run) for i in range(args.repeat)]
+        wall = np.median([w for w, loaded in runs])
+        loaded = runs[0][1]
+        ok = wall <= args.budget and len(loaded) == 0
+        failed |= not ok
+        results[name] = {'wall_median': wall, 'heavy_modules': loaded,
+                'ok': ok}
+        status = 'ok' if wall <= args.budget else 'over budget'
+        if loaded: status += f', loaded {", ".join(loaded)}'
+        print(f'{name:<20} {wall:6.3f} s  {status}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'budget': args.budget, 'results': results}, f,
+                    indent=2)
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+'''
+Checks linechain.label_lines against an exhaustive permutation search for
+small models, and that a model with many lines is labelled within a time
+and memory bound, matching scipy's linear_sum_assignment row by row.
+
+Usage: PYTHONPATH=src python tests/label_lines_test.py
+'''
+
+import time
+import itertools
+import tracemalloc
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+import linechain as lc
+
+# Bounds for labelling the large model
+n_lines = 12
+n_rows = 20000
+max_seconds = 10
+max_mb = 200
+
+rng = np.random.RandomState(0)
+
+def sample(model, n):
+    ''' Returns rows of shuffled, scattered line frequencies and the modes '''
+    modes = np.sort(rng.uniform(1e-3, 1e-1, model))
+    freqs = modes * (1 + 0.05 * rng.standard_normal((n, model)))
+    return np.array([rng.permutation(row) for row in freqs]), modes
+
+def score(freqs, modes, idx):
+    ''' Returns the harmonic score of each row for the given labelling '''
+    labelled = np.take_along_axis(freqs, idx, axis=1)
+    return (1 / np.maximum(np.abs(labelled - modes) / modes, 1e-300)).sum(1)
+
+# Small models: same result as scoring every permutation
+for model in range(2, 8):
+    freqs, modes = sample(model, 2000)
+    idx = lc.label_lines(freqs, modes)
+    perms = np.array(list(itertools.permutations(range(model))))
+    best = np.max([score(freqs, modes, np.broadcast_to(p, freqs.shape))
+            for p in perms], axis=0)
+    np.testing.assert_allclose(score(freqs, modes, idx), best, rtol=1e-12)
+print('Models of 2-7 lines match the permutation search.')
+
+# Large model: bounded time and memory
+freqs, modes = sample(n_lines, n_rows)
+tracemalloc.start()
+start = time.perf_counter()
+idx = lc.label_lines(freqs, modes)
+seconds = time.perf_counter() - start
+peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+tracemalloc.stop()
+print(f'{n_lines} lines, {n_rows} rows: {seconds:.2f} s, {peak_mb:.0f} MB')
+assert seconds < max_seconds, f'took longer than {max_seconds} s'
+assert peak_mb < max_mb, f'used more than {max_mb} MB'
+
+# Optimal assignment for a subset of rows
+for i in rng.choice(n_rows, 200, replace=False):
+    row_score = 1 / np.maximum(np.abs(freqs[i,:,np.newaxis] - modes) / modes,
+            1e-300)
+    modes_idx, lines_idx = linear_sum_assignment(-row_score.T)
+    expected = row_score[lines_idx, modes_idx].sum()
+    np.testing.assert_allclose(score(freqs[i:i+1], modes, idx[i:i+1])[0],
+            expected, rtol=1e-12)
+print('Large model matches linear_sum_assignment.')
@@ -0,0 +1,39 @@
+'''
+Checks psd.lomb_scargle_fast against the exact psd.lomb_scargle, both on
+the PSD cadence with gaps that fft(method='lombscargle-fast') receives and
+on irregular times.
+
+Usage: PYTHONPATH=src python tests/lomb_scargle_test.py
+'''
+
+import numpy as np
+
+import psd
+
+# Maximum relative error of the fast periodogram
+max_error = 1e-8
+
+rng = np.random.RandomState(0)
+
+def check(times, values, freqs, label):
+    exact = psd.lomb_scargle(times, values, freqs)
+    fast = psd.lomb_scargle_fast(times, values, freqs)
+    error = np.max(np.abs(fast - exact) / exact)
+    print(f'{label}: max relative error {error:.2e}')
+    assert error < max_error, f'{label}: {error} >= {max_error}'
+
+# PSD cadence: 1638 s between times, with gaps and NaN values
+dt = 1638
+steps = np.where(rng.uniform(size=3000) < 0.02, 
+        dt * rng.randint(2, 20, 3000), dt)
+times = np.cumsum(steps + rng.normal(0, 3, 3000))
+values = rng.standard_normal((3000, 20)) \
+        + np.sin(2 * np.pi * 1e-5 * times)[:,np.newaxis]
+values[rng.uniform(size=values.shape) < 0.01] = np.nan
+dt, n = psd.time_grid(times)
+check(times, values, np.fft.rfftfreq(n, dt)[1:], 'PSD cadence with gaps')
+
+# Irregular times
+times = np.sort(rng.uniform(0, 1e6, 2000))
+values = rng.standard_normal((2000, 20))
+check(times, values, np.arange(1, 1001) * 1e-6, 'Irregular times')
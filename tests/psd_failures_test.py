@@ -0,0 +1,58 @@
+'''
+Checks that psd.save_summary quarantines corrupt time directories: with
+one corrupt time directory the rest are still summarized, and with every
+time directory corrupt it raises a clear error after writing the
+quarantine report.
+
+Usage: PYTHONPATH=src python tests/psd_failures_test.py
+'''
+
+import os
+import sys
+import glob
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import synthetic
+import cache
+import psd
+import utils
+
+cache.configure(use_cache=False)
+
+def corrupt(time_dir):
+    ''' Overwrites every psd.dat file in a time directory with bad rows '''
+    for chain_file in glob.glob(os.path.join(time_dir, 'psd.dat.*')):
+        with open(chain_file, 'w') as f:
+            f.write('not a psd\n')
+
+root = tempfile.mkdtemp(prefix='psd_failures_')
+run_path = synthetic.generate_run(root, n_times=6, gaps=(), n_chains=5,
+        n_freqs=50, n_samples=20)
+os.chdir(root)
+
+# One corrupt time directory: filled with NaN and quarantined
+run = utils.Run(run_path)
+corrupt(run.time_dirs[0])
+summary = psd.save_summary(run)
+assert np.isnan(summary.get('MEDIAN', run.channels[0], 
+        run.gps_times[0])).all()
+assert not np.isnan(summary.get('MEDIAN', run.channels[0], 
+        run.gps_times[1])).all()
+assert os.path.exists(run.psd_quarantine)
+print('One corrupt time directory is quarantined.')
+
+# Every time directory corrupt: a clear error instead of a missing file
+for time_dir in run.time_dirs: corrupt(time_dir)
+run = utils.Run(run_path)
+try:
+    psd.save_summary(run)
+except ValueError as e:
+    assert 'no time directory could be summarized' in str(e), e
+else:
+    raise AssertionError('save_summary did not raise')
+with open(run.psd_quarantine) as f:
+    assert f.readline().startswith(f'{len(run.time_dirs)} inputs failed')
+print('Every corrupt time directory raises ValueError.')
@@ -0,0 +1,224 @@
+'''
+Generates synthetic runs in the layout utils.Run expects, for testing and
+benchmarking without the real data:
+
+    <root>/data/<mode>/<run>/<run>_<gps>/psd.dat.<chain>
+    <root>/data/<mode>/<run>/<run>_<gps>/linechain_channel<channel>.dat
+
+Each psd.dat file holds one PSD chain sample: a frequency column followed
+by one column per channel. The PSD is a red noise floor which drifts slowly
+over time, plus the spectral lines of the line model, with a few rows of 2s
+at the highest frequencies like the real data. Each linechain file holds
+one sample per row: the model number followed by the frequency, amplitude
+and quality factor of each line. Time directories can be left out to make
+gaps in the run.
+
+Usage: python tests/synthetic.py <root> [options]
+'''
+
+import os
+import argparse
+
+import numpy as np
+
+# Channel names, as in utils.Run
+channels = ['x', 'y', 'z', 'θ', 'η', 'ϕ']
+# Default line model: frequency (Hz), amplitude and quality factor of each
+# line which can appear, in order of appearance
+default_lines = [(0.01, 1e-14, 50.), (0.03, 5e-15, 100.), (0.07, 2e-15, 200.)]
+# Default probability of each model number, i.e. of 0, 1, 2, ... lines
+default_model_probs = [0.1, 0.2, 0.5, 0.2]
+
+def get_gps_times(n_times, gaps=(), start=1159724317, dt=1638):
+    '''
+    Returns an array of the GPS times of the time directories to write.
+
+    Input
+    -----
+      n_times : int, number of time steps in the run, including gaps
+      gaps : list of (index, length) tuples of time steps to leave out
+      start : int, GPS time of the first time step
+      dt : int, time step in seconds
+    '''
+    keep = np.ones(n_times, dtype=bool)
+    for index, length in gaps:
+        keep[index:index+length] = False
+    return start + dt * np.flatnonzero(keep)
+
+def get_freqs(n_freqs, f_min=6e-4, f_max=1.):
+    '''
+    Returns about n_freqs log-spaced frequencies, rounded to 5 decimals like
+    the readers do. Duplicates after rounding are dropped, so fewer may be
+    returned for large n_freqs.
+    '''
+    freqs = np.round(np.logspace(np.log10(f_min), np.log10(f_max), n_freqs), 5)
+    return np.unique(freqs)
+
+def psd_model(freqs, gps_times, lines, seed=0):
+    '''
+    Returns the expected PSD with index order [time, frequency, channel]:
+    a red noise floor with a slow periodic drift over time, plus a Lorentzian
+    peak for each line.
+    '''
+    rng = np.random.RandomState(seed)
+    # Noise floor of each channel
+    level = 1e-14 * (1 + rng.rand(len(channels)))
+    floor = level * (1 + (freqs[:,np.newaxis] / 2e-3) ** -2)
+    # Drift with a period of about 30 days
+    days = (gps_times - gps_times[0]) / (60*60*24)
+    drift = 1 + 0.2 * np.sin(2 * np.pi * days / 30)
+    psd = drift[:,np.newaxis,np.newaxis] * floor
+    for f0, amp, q in lines:
+        width = f0 / (2 * q)
+        psd += (amp / (1 + ((freqs - f0) / width) ** 2))[:,np.newaxis]
+    return psd
+
+def write_psd_chains(time_dir, freqs, psd, n_chains=100, n_flagged=3,
+        noise=0.1, extra_columns=1, rng=None):
+    '''
+    Writes psd.dat.0 to psd.dat.<n_chains-1> in a time directory. Each chain
+    is the expected PSD with log-normal noise.
+
+    Input
+    -----
+      time_dir : string, path to the time directory
+      freqs : 1D array of frequencies
+      psd : 2D array of the expected PSD, [frequency, channel]
+      n_chains : int, number of chain files
+      n_flagged : int, number of rows of 2s at the highest frequencies
+      noise : float, standard deviation of the log-normal noise
+      extra_columns : int, number of unused columns after the channels
+      rng : numpy RandomState
+    '''
+    if rng is None: rng = np.random.RandomState()
+    for c in range(n_chains):
+        values = psd * np.exp(noise * rng.standard_normal(psd.shape))
+        if n_flagged > 0: values[-n_flagged:] = 2.
+        data = np.column_stack([freqs, values,
+                np.zeros((len(freqs), extra_columns))])
+        np.savetxt(os.path.join(time_dir, f'psd.dat.{c}'), data, fmt='%.17g')
+
+def write_linechain(lc_file, lines, model_probs, n_samples=500, scatter=1e-3,
+        rng=None):
+    '''
+    Writes a linechain file. The model number of each sample is drawn from
+    model_probs, and the first lines of the line model are included in a
+    random order with scattered parameters.
+
+    Input
+    -----
+      lc_file : string, path to the linechain file
+      lines : list of (frequency, amplitude, quality factor) tuples
+      model_probs : list of the probability of each model number
+      n_samples : int, number of rows
+      scatter : float, relative scatter of the line frequencies
+      rng : numpy RandomState
+    '''
+    if rng is None: rng = np.random.RandomState()
+    lines = np.array(lines, dtype='float64').reshape(-1, 3)
+    model_probs = np.asarray(model_probs, dtype='float64')
+    models = rng.choice(len(model_probs), size=n_samples,
+            p=model_probs / model_probs.sum())
+    rows = []
+    for model in models:
+        params = lines[rng.permutation(model)]
+        # Frequencies scatter little; amplitudes and quality factors a lot
+        params *= np.exp(rng.standard_normal(params.shape)
+                * [scatter, 0.3, 0.3])
+        rows.append(' '.join([str(model)]
+                + [f'{x:.17g}' for x in params.flatten()]))
+    with open(lc_file, 'w') as f:
+        f.write('\n'.join(rows) + '\n')
+
+def write_impacts(impacts_file, gps_times, n_impacts=5, rng=None):
+    ''' Writes an impacts file in the format of psd.get_impacts() '''
+    if rng is None: rng = np.random.RandomState()
+    impact_times = np.sort(rng.randint(gps_times[0], gps_times[-1], n_impacts))
+    with open(impacts_file, 'w') as f:
+        for gps in impact_times:
+            f.write(f'2016-01-01 {gps} {10 * rng.rand():.1f} +0.5 -0.5 '
+                    + ' '.join(['-'] * 6) + ' 0.1 0.2 0.3\n')
+
+def generate_run(root, name='run_s', mode='drs', n_times=50, gaps=((5, 2),),
+        n_chains=100, n_freqs=200, n_samples=500, lines=default_lines,
+        model_probs=default_model_probs, quiet_channels=(), dt=1638,
+        impacts=0, seed=0):
+    '''
+    Writes a synthetic run and returns its path relative to root, which is
+    the path to give utils.Run when working from root.
+
+    Input
+    -----
+      root : string, working directory in which to create data/
+      name : string, run name
+      mode : string, run mode directory
+      n_times : int, number of time steps including gaps
+      gaps : list of (index, length) tuples of time steps to leave out
+      n_chains : int, number of psd.dat files per time directory
+      n_freqs : int, approximate number of frequencies
+      n_samples : int, number of rows in each linechain file
+      lines : list of (frequency, amplitude, quality factor) tuples
+      model_probs : list of the probability of each model number
+      quiet_channels : list of channel indices which always have 0 lines
+      dt : int, time step in seconds
+      impacts : int, number of impacts to write to <root>/impacts.dat
+      seed : int, random seed
+    '''
+    rng = np.random.RandomState(seed)
+    run_path = os.path.join('data', mode, name)
+    gps_times = get_gps_times(n_times, gaps, dt=dt)
+    freqs = get_freqs(n_freqs)
+    psd = psd_model(freqs, gps_times, lines, seed)
+    for t, gps in enumerate(gps_times):
+        time_dir = os.path.join(root, run_path, f'{name}_{gps}')
+        os.makedirs(time_dir, exist_ok=True)
+        write_psd_chains(time_dir, freqs, psd[t], n_chains, rng=rng)
+        for c in range(len(channels)):
+            lc_file = os.path.join(time_dir, f'linechain_channel{c}.dat')
+            probs = [1.] if c in quiet_channels else model_probs
+            write_linechain(lc_file, lines, probs, n_samples, rng=rng)
+    if impacts > 0:
+        write_impacts(os.path.join(root, 'impacts.dat'), gps_times, impacts,
+                rng)
+    return run_path + os.sep
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic run.')
+    parser.add_argument('root', type=str,
+        help='working directory in which to create data/<mode>/<name>/')
+    parser.add_argument('-n', '--name', default='run_s', help='run name')
+    parser.add_argument('-m', '--mode', default='drs', help='run mode')
+    parser.add_argument('-t', '--times', type=int, default=50,
+        help='number of time steps, including gaps (default: 50)')
+    parser.add_argument('--gaps', type=str, nargs='*', default=['5:2'],
+        help='gaps as index:length pairs of time steps to leave out \
+              (default: 5:2)')
+    parser.add_argument('--chains', type=int, default=100,
+        help='number of psd.dat files per time directory (default: 100)')
+    parser.add_argument('--freqs', type=int, default=200,
+        help='approximate number of frequencies (default: 200)')
+    parser.add_argument('--samples', type=int, default=500,
+        help='number of samples in each linechain file (default: 500)')
+    parser.add_argument('--lines', type=str, nargs='*',
+        default=[','.join(map(str, line)) for line in default_lines],
+        help='line model as frequency,amplitude,quality triplets')
+    parser.add_argument('--model-probs', dest='model_probs', type=float,
+        nargs='*', default=default_model_probs,
+        help='probability of each model number, starting at 0 lines')
+    parser.add_argument('--quiet-channels', dest='quiet', type=int,
+        nargs='*', default=[],
+        help='indices of channels which never have lines')
+    parser.add_argument('--impacts', type=int, default=5,
+        help='number of impacts to write to <root>/impacts.dat (default: 5)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    gaps = [tuple(map(int, gap.split(':'))) for gap in args.gaps]
+    lines = [tuple(map(float, line.split(','))) for line in args.lines]
+    run_path = generate_run(args.root, args.name, args.mode, args.times, gaps,
+            args.chains, args.freqs, args.samples, lines, args.model_probs,
+            args.quiet, impacts=args.impacts, seed=args.seed)
+    print(f'Wrote {os.path.join(args.root, run_path)}')
+
+if __name__ == '__main__':
+    main()